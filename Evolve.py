@@ -2,6 +2,14 @@ from abc import ABC, abstractmethod
 from typing import List, Tuple
 
 class EvolveInterface(ABC):
+    # True if two instances of the interface can build and evaluate candidates
+    # at the same time without stepping on each other's files.
+    ISOLATED_WORKSPACES = False
+    # True if the interface also implements snapshot() (a handle to the last successful build that
+    # stays valid across later builds) and run_experiment_group(handles) (evaluates snapshotted
+    # builds together, returning one (eval_status, eval_results, eval_logs) per handle), which --race needs.
+    SUPPORTS_GROUP_EVAL = False
+
     @abstractmethod
     def initial_prompt(self) -> str:
         pass
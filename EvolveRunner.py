@@ -1,4 +1,8 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import OperationFailure
+import datetime
+import queue
+import threading
 import time
 
 from utils import get_git_info
@@ -11,6 +15,23 @@ from tcp_cc.kern_mod.interface import TCPEvolve
 from tcp_cc.bpf_scaffolding.interface import CongestionControlBPF
 from webcache.interface import WebCacheEvolve
 from llm_wrappers import get_wrapper, ALL_LLM_MODELS
+from leaderboard import Leaderboard
+from candidate_cache import CandidateCache
+from blob_store import open_blob_store, offload_document
+
+def ensure_sample_index(collection):
+    """
+    Unique (iter, _sample) index of a run's collection, so a sample can only be stored once.
+    Collections from before it was unique have a plain index on the same keys, which is replaced.
+    """
+    keys = [("iter", ASCENDING), ("_sample", ASCENDING)]
+    for index in collection.list_indexes():
+        if list(index["key"].items()) == keys and not index.get("unique", False):
+            try:
+                collection.drop_index(index["name"])
+            except OperationFailure:
+                pass # another worker replaced it first
+    collection.create_index(keys, unique=True)
 
 class EvolutionRunner:
     EVOLVE_REGISTRY = {
@@ -18,11 +39,15 @@ class EvolutionRunner:
         "tcpbpf": CongestionControlBPF,
         "webcache": WebCacheEvolve,
     }
+    # what resuming needs from a stored sample: the leaderboard fields plus its build/eval outcome
+    RESUME_PROJECTION = {**Leaderboard.PROJECTION, "_sample": 1, "build_status": 1, "exec_status": 1, "eval_results.partial": 1}
     
     def __init__(
         self, task_name: str, llm_name: str,
         n_samples: int, start_iter_idx, end_iter_idx: int,
-        collection_id, task_args, n_build_retries = 3
+        collection_id, task_args, n_build_retries = 3, n_workers = 1,
+        num_snippets = 2, llm_cache = None, dedup = False, race = False,
+        blob_store = None, blob_threshold = 4096
     ):
         self.task_name = task_name
         self.llm_name = llm_name
@@ -31,13 +56,25 @@ class EvolutionRunner:
         self.end_iter_idx = end_iter_idx
         self.collection_id = collection_id
         self.n_build_retries = n_build_retries
+        self.n_workers = n_workers
+        self.num_snippets = num_snippets
+        self.llm_cache = llm_cache
+        self.dedup = dedup
+        self.race = race
+        self.blob_threshold = blob_threshold
 
         self.client = MongoClient(MONGO_CONNECTION_STRING)
         self.db = self.client["policysmith"]
+        # large logs go to a blob store, documents keep a preview and a reference (see blob_store.py)
+        self.blob_store = open_blob_store(blob_store, self.db) if blob_store is not None else None
 
         assert self.task_name in self.EVOLVE_REGISTRY.keys()
         assert self.llm_name in ALL_LLM_MODELS.keys()
         assert self.end_iter_idx > self.start_iter_idx
+        if self.race:
+            # racing evaluates snapshotted builds as a group; fail before any generation if the task cannot
+            interface_class = self.EVOLVE_REGISTRY[self.task_name]
+            assert interface_class.SUPPORTS_GROUP_EVAL, f"--race needs group evaluation, which {interface_class.__name__} does not support"
         
         existing_collections = self.db.list_collection_names()
 
@@ -54,110 +91,340 @@ class EvolutionRunner:
             print(f"Using NEW collection name = {self.collection_id}")
         
         self.interface = self.EVOLVE_REGISTRY[self.task_name](task_args)
+        # interfaces with isolated workspaces get one instance per worker; others share one
+        self.interfaces = [self.interface]
+        if self.interface.ISOLATED_WORKSPACES:
+            self.interfaces += [self.EVOLVE_REGISTRY[self.task_name](task_args) for _ in range(self.n_workers - 1)]
+        self.leaderboard = Leaderboard(self.db[self.collection_id], self.num_snippets)
+        ensure_sample_index(self.db[self.collection_id])
         info = self.interface.run_info()
+        self.candidate_cache = None
+        if self.dedup:
+            self.candidate_cache = CandidateCache(self.db["candidate_cache"], self.task_name, info["task_args"])
         info["collection_id"] = self.collection_id
         info["policysmith_githash"] = get_git_info()
         self.db["information"].insert_one(info)
 
     
-    def get_priority_programs(self, iter_num, num_snippets=2):
-        collection = self.db[self.collection_id]
-
-        self.all_valid_programs = list(collection.find({
-            "iter": {"$lte": iter_num}, 
-            "build_status": True, 
-            "exec_status": True
-        }))
-
-        if len(self.all_valid_programs) < 2:
-            raise ValueError(f"Expected at least 2 successful programs in iteration {iter_num}, found {len(self.all_valid_programs)}")
-           
-        self.all_valid_programs = sorted(
-            self.all_valid_programs,
-            key=lambda doc: doc["eval_results"]["score"],
-            reverse=True
+    def get_priority_programs(self, iter_num):
+        if not self.leaderboard.loaded:
+            self.leaderboard.load(iter_num)
+        top_programs = self.leaderboard.top()
+
+        if len(top_programs) < self.num_snippets:
+            raise ValueError(f"Expected at least {self.num_snippets} successful programs in iteration {iter_num}, found {len(top_programs)}")
+
+        self.priority_program_ids = [entry["_id"] for entry in top_programs]
+        self.priority_programs = [entry["final_code"] for entry in top_programs]
+        print(f"Best score seen in iter={iter_num} is {top_programs[0]['score']}")
+
+    def new_document(self, _iter, _sample):
+        heuristic_mongo_document = {
+            "iter": _iter,
+            "_sample": _sample,
+            "final_code": None,
+            "build_status": None,
+            "exec_status": None,
+            "eval_results": None,
+            "eval_logs": None,
+            "revisions": [],
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+            # wall-clock seconds per phase; timing_report.py summarizes them per collection
+            "timings": {"llm": [], "build": [], "eval": None, "total_seconds": None}
+        }
+        if _iter > 0:
+            heuristic_mongo_document["priority_program_ids"] = self.priority_program_ids
+            heuristic_mongo_document["priority_programs"] = self.priority_programs
+        return heuristic_mongo_document
+
+    def generate(self, _iter, _sample):
+        """
+        Asks the LLM for a new heuristic. Returns (document, llm_chat, llm_response)
+        """
+        print(f"[{round(time.time()-START_TIME, 2)}] Generating iter={_iter}; sample={_sample}")
+        # start a new chat for every heuristic; cached replies are per sample, so samples stay distinct
+        llm_chat = get_wrapper(self.llm_name, cache=self.llm_cache, chat_id={"iter": _iter, "_sample": _sample})
+        heuristic_mongo_document = self.new_document(_iter, _sample)
+
+        # send the initial prompt requesting a new heuristic
+        if _iter == 0:
+            prompt = self.interface.initial_prompt()
+        else:
+            prompt = self.interface.mutate_prompt(self.priority_programs)
+
+        llm_response = self.send_message(heuristic_mongo_document, llm_chat, prompt)
+        return heuristic_mongo_document, llm_chat, llm_response
+
+    def send_message(self, heuristic_mongo_document, llm_chat, prompt):
+        start = time.time()
+        llm_response = llm_chat.send_message(prompt)
+        stats = llm_response["stats"]
+        heuristic_mongo_document["timings"]["llm"].append({
+            "seconds": time.time() - start,
+            "prompt_tokens": stats.get("prompt_tokens"),
+            "gen_tokens": stats.get("gen_tokens"),
+            "cached": stats.get("cached", False)
+        })
+        return llm_response
+
+    def build(self, interface, heuristic_mongo_document, llm_chat, llm_response):
+        """
+        Attempts to build the heuristic, asking the LLM to fix it on failure. Returns the build status.
+        """
+        success = False
+        for _attempt_count in range(self.n_build_retries):
+            if len(llm_response['code_segs'][0]) > 0:
+                code = llm_response['code_segs'][0]
+                start = time.time()
+                cached = self.lookup_candidate(heuristic_mongo_document, code)
+                if cached is not None:
+                    success, stdout, stderr = cached["build_status"], cached["stdout"], cached["stderr"]
+                else:
+                    success, stdout, stderr = interface.build(code)
+                    if not success and self.candidate_cache is not None:
+                        self.candidate_cache.store(heuristic_mongo_document["dedup"]["hash"], code, build_status=False, stdout=stdout, stderr=stderr)
+                heuristic_mongo_document["timings"]["build"].append({"seconds": time.time() - start, "success": success, "deduplicated": cached is not None})
+                print(f"\t[{round(time.time() - START_TIME, 2)}] iter={heuristic_mongo_document['iter']}; sample={heuristic_mongo_document['_sample']} Build {_attempt_count+1} status: {success}{' (deduplicated)' if cached is not None else ''}")
+                heuristic_mongo_document["revisions"].append(
+                    {
+                        "build_status": success,
+                        "stdout": stdout,
+                        "stderr": stderr,
+                        "deduplicated": cached is not None,
+                        **llm_response
+                    }
+                )
+
+                heuristic_mongo_document["final_code"] = llm_response['code_segs'][0]
+                heuristic_mongo_document["build_status"] = success
+
+                if success or _attempt_count == self.n_build_retries - 1:
+                    break
+                debug_prompt = interface.debug_prompt(stdout, stderr)
+            else:
+                heuristic_mongo_document["revisions"].append(
+                    {
+                        "build_status": False,
+                        "stdout": "Could not find a code block inside your response.",
+                    }
+                )
+                heuristic_mongo_document["build_status"] = False
+                debug_prompt = "Could not find a code block inside your previous message. Please format correctly."
+
+            llm_response = self.send_message(heuristic_mongo_document, llm_chat, debug_prompt)
+
+        assert heuristic_mongo_document["build_status"] == success, "Just a sanity check"
+        return success
+
+    def lookup_candidate(self, heuristic_mongo_document, code):
+        """
+        Returns the stored results of an equivalent candidate, if deduplication is on and one exists.
+        """
+        if self.candidate_cache is None:
+            return None
+        key = self.candidate_cache.key(code)
+        cached = self.candidate_cache.lookup(key)
+        heuristic_mongo_document["dedup"] = {"hash": key, "hit": cached is not None}
+        return cached
+
+    def evaluate(self, interface, heuristic_mongo_document):
+        if self.evaluate_from_cache(heuristic_mongo_document):
+            return
+        start = time.time()
+        eval_status, eval_results, eval_logs = interface.run_experiment()
+        heuristic_mongo_document["timings"]["eval"] = {"seconds": time.time() - start}
+        self.record_evaluation(heuristic_mongo_document, eval_status, eval_results, eval_logs)
+
+    def evaluate_from_cache(self, heuristic_mongo_document):
+        dedup = heuristic_mongo_document.get("dedup")
+        if dedup is None or not dedup["hit"]:
+            return False
+        cached = self.candidate_cache.lookup(dedup["hash"])
+        heuristic_mongo_document["exec_status"] = cached["exec_status"]
+        heuristic_mongo_document["eval_results"] = cached["eval_results"]
+        heuristic_mongo_document["eval_logs"] = cached["eval_logs"]
+        heuristic_mongo_document["exec_failure_reason"] = None if cached["exec_status"] else (cached["eval_logs"] or {}).get("failure_reason")
+        heuristic_mongo_document["timings"]["eval"] = {"seconds": 0.0, "deduplicated": True}
+        print(f"\t[{round(time.time() - START_TIME, 2)}] iter={heuristic_mongo_document['iter']}; sample={heuristic_mongo_document['_sample']} eval: {cached['exec_status']} (deduplicated)")
+        return True
+
+    def record_evaluation(self, heuristic_mongo_document, eval_status, eval_results, eval_logs):
+        print(f"\t[{round(time.time() - START_TIME, 2)}] iter={heuristic_mongo_document['iter']}; sample={heuristic_mongo_document['_sample']} eval: {eval_status}")
+        heuristic_mongo_document["exec_status"] = eval_status
+        heuristic_mongo_document["eval_results"] = eval_results
+        heuristic_mongo_document["eval_logs"] = eval_logs
+        # why the evaluation failed (e.g. wall_time_limit, cpu_time_limit, memory_limit), if the task reports it
+        heuristic_mongo_document["exec_failure_reason"] = None if eval_status else (eval_logs or {}).get("failure_reason")
+        dedup = heuristic_mongo_document.get("dedup")
+        # partial (racing) results depend on the other candidates in the race, so they are not cached
+        if dedup is not None and not (eval_results or {}).get("partial", False):
+            revision = heuristic_mongo_document["revisions"][-1]
+            self.candidate_cache.store(
+                dedup["hash"], heuristic_mongo_document["final_code"],
+                build_status=True, stdout=revision["stdout"], stderr=revision["stderr"],
+                exec_status=eval_status, eval_results=eval_results, eval_logs=eval_logs
+            )
+
+    def write(self, heuristic_mongo_document):
+        heuristic_mongo_document["timings"]["total_seconds"] = (datetime.datetime.now(datetime.timezone.utc) - heuristic_mongo_document["created_at"]).total_seconds()
+        if self.blob_store is not None:
+            offload_document(heuristic_mongo_document, self.blob_store, self.blob_threshold)
+        if self.store(heuristic_mongo_document):
+            self.leaderboard.offer(heuristic_mongo_document)
+
+    def store(self, heuristic_mongo_document):
+        """
+        Inserts a finished document. Returns whether it was stored.
+        """
+        self.db[self.collection_id].insert_one(heuristic_mongo_document)
+        return True
+
+    def completed_samples(self):
+        """
+        Loads every sample already stored for the iterations of this run with one indexed query,
+        as {iter: {_sample: record}}.
+        """
+        completed = {}
+        cursor = self.db[self.collection_id].find(
+            {"iter": {"$gte": self.start_iter_idx, "$lt": self.end_iter_idx}},
+            self.RESUME_PROJECTION
         )
+        for record in cursor:
+            completed.setdefault(record["iter"], {}).setdefault(record["_sample"], record)
+        return completed
 
-        self.priority_program_ids = [doc["_id"] for doc in self.all_valid_programs[:num_snippets]]
-        self.priority_programs = [doc["final_code"] for doc in self.all_valid_programs[:num_snippets]]
-        print(f"Best score seen in iter={iter_num} is {self.all_valid_programs[0]['eval_results']['score']}")
+    def pending_samples(self, _iter, completed):
+        pending = []
+        for _sample in range(self.n_samples):
+            record = completed.get(_iter, {}).get(_sample)
+            if record:
+                print(f"Skipping iter={_iter}, sample={_sample} since we found it in MongoDB.")
+                self.leaderboard.offer(record)
+                continue
+            pending.append(_sample)
+        return pending
 
     def evolve(self):
+        completed = self.completed_samples()
         for _iter in range(self.start_iter_idx, self.end_iter_idx):
             if _iter > 0:
                 self.get_priority_programs(_iter - 1)
-            for _sample in range(self.n_samples):
-                record = self.db[self.collection_id].find_one({
-                    "iter": _iter,
-                    "_sample": _sample
-                })
-                if record:
-                    print(f"Skipping iter={_iter}, sample={_sample} since we found it in MongoDB.")
-                    continue
-                
-                print(f"[{round(time.time()-START_TIME, 2)}] Generating iter={_iter}; sample={_sample}")
-                llm_chat = get_wrapper(self.llm_name) # start a new chat for every heuristic
-
-                heuristic_mongo_document = {
-                    "iter": _iter,
-                    "_sample": _sample,
-                    "final_code": None,
-                    "build_status": None,
-                    "exec_status": None,
-                    "eval_results": None,
-                    "eval_logs": None,
-                    "revisions": []
-                }
-
-                # send the initial prompt requesting a new heuristic
-                if _iter == 0:
-                    prompt = self.interface.initial_prompt()
+            # stored samples are offered to the leaderboard only now, after parents were picked from earlier iterations
+            samples = self.pending_samples(_iter, completed)
+            if self.race:
+                self.evolve_racing(_iter, samples)
+            elif self.n_workers > 1:
+                self.evolve_pipelined(_iter, samples)
+            else:
+                for _sample in samples:
+                    heuristic_mongo_document, llm_chat, llm_response = self.generate(_iter, _sample)
+                    if self.build(self.interface, heuristic_mongo_document, llm_chat, llm_response):
+                        self.evaluate(self.interface, heuristic_mongo_document)
+                    # write the doc to mongo
+                    self.write(heuristic_mongo_document)
+
+            if self.llm_cache is not None:
+                print(f"[{round(time.time()-START_TIME, 2)}] LLM cache after iter={_iter}: {self.llm_cache.stats()}")
+
+    def evolve_racing(self, _iter, samples):
+        """
+        Builds every sample of the iteration first, then evaluates all successful builds as one
+        group with interface.run_experiment_group, which can stop bad candidates early.
+        """
+        racing = []
+        for _sample in samples:
+            heuristic_mongo_document, llm_chat, llm_response = self.generate(_iter, _sample)
+            if not self.build(self.interface, heuristic_mongo_document, llm_chat, llm_response) or self.evaluate_from_cache(heuristic_mongo_document):
+                self.write(heuristic_mongo_document)
+                continue
+            racing.append((heuristic_mongo_document, self.interface.snapshot()))
+
+        if len(racing) == 0:
+            return
+        print(f"[{round(time.time()-START_TIME, 2)}] Racing {len(racing)} candidates of iter={_iter}")
+        start = time.time()
+        outputs = self.interface.run_experiment_group([handle for _, handle in racing])
+        race_seconds = time.time() - start
+        for (heuristic_mongo_document, _), (eval_status, eval_results, eval_logs) in zip(racing, outputs):
+            # the race is one group run; each candidate gets an equal share of it
+            heuristic_mongo_document["timings"]["eval"] = {"seconds": race_seconds / len(racing), "race_seconds": race_seconds, "raced": len(racing)}
+            self.record_evaluation(heuristic_mongo_document, eval_status, eval_results, eval_logs)
+            self.write(heuristic_mongo_document)
+
+    def evolve_pipelined(self, _iter, samples):
+        """
+        Runs one iteration as a three stage pipeline (LLM generation -> build -> evaluation) connected
+        by bounded queues. Interfaces are checked out of a pool by the build stage and returned by the
+        evaluation stage, so a candidate is always evaluated in the workspace it was built in.
+        """
+        sample_queue = queue.Queue()
+        for _sample in samples:
+            sample_queue.put(_sample)
+        build_queue = queue.Queue(maxsize=self.n_workers)
+        eval_queue = queue.Queue(maxsize=len(self.interfaces))
+        done_queue = queue.Queue()
+        interface_pool = queue.Queue()
+        for interface in self.interfaces:
+            interface_pool.put(interface)
+
+        def run_stage(fn):
+            def worker():
+                try:
+                    fn()
+                except BaseException as e:
+                    done_queue.put(e)
+            thread = threading.Thread(target=worker, daemon=True)
+            thread.start()
+            return thread
+
+        def generate_stage():
+            while True:
+                try:
+                    _sample = sample_queue.get_nowait()
+                except queue.Empty:
+                    return
+                build_queue.put(self.generate(_iter, _sample))
+
+        def build_stage():
+            while True:
+                item = build_queue.get()
+                if item is None:
+                    return
+                heuristic_mongo_document, llm_chat, llm_response = item
+                interface = interface_pool.get()
+                if self.build(interface, heuristic_mongo_document, llm_chat, llm_response):
+                    eval_queue.put((heuristic_mongo_document, interface))
                 else:
-                    heuristic_mongo_document["priority_program_ids"] = self.priority_program_ids
-                    heuristic_mongo_document["priority_programs"] = self.priority_programs
-                    prompt = self.interface.mutate_prompt(self.priority_programs)
-                
-                llm_response = llm_chat.send_message(prompt)
-                # attempt to build; retry on failure
-                
-                for _attempt_count in range(self.n_build_retries):
-                    if len(llm_response['code_segs'][0]) > 0:
-                        success, stdout, stderr = self.interface.build(llm_response['code_segs'][0])
-                        print(f"\t[{round(time.time() - START_TIME, 2)}] Build {_attempt_count+1} status: {success}")
-                        heuristic_mongo_document["revisions"].append(
-                            {
-                                "build_status": success,
-                                "stdout": stdout,
-                                "stderr": stderr,
-                                **llm_response
-                            }
-                        )
-
-                        heuristic_mongo_document["final_code"] = llm_response['code_segs'][0]
-                        heuristic_mongo_document["build_status"] = success
-
-                        if success or _attempt_count == self.n_build_retries - 1:
-                            break
-                        debug_prompt = self.interface.debug_prompt(stdout, stderr)
-                    else:
-                        heuristic_mongo_document["revisions"].append(
-                            {
-                                "build_status": False,
-                                "stdout": "Could not find a code block inside your response.",
-                            }
-                        )
-                        debug_prompt = "Could not find a code block inside your previous message. Please format correctly."
-                    
-                    llm_response = llm_chat.send_message(debug_prompt)
-                
-                assert heuristic_mongo_document["build_status"] == success, "Just a sanity check" 
-                
-                if success:
-                    eval_status, eval_results, eval_logs = self.interface.run_experiment()
-                    print(f"\t[{round(time.time() - START_TIME, 2)}] Build {_attempt_count+1} eval: {success}")
-                    heuristic_mongo_document["exec_status"] = eval_status
-                    heuristic_mongo_document["eval_results"] = eval_results
-                    heuristic_mongo_document["eval_logs"] = eval_logs
-                # write the doc to mongo 
-                collection = self.db[self.collection_id]
-                collection.insert_one(heuristic_mongo_document)
+                    interface_pool.put(interface)
+                    done_queue.put(heuristic_mongo_document)
+
+        def eval_stage():
+            while True:
+                item = eval_queue.get()
+                if item is None:
+                    return
+                heuristic_mongo_document, interface = item
+                try:
+                    self.evaluate(interface, heuristic_mongo_document)
+                finally:
+                    interface_pool.put(interface)
+                done_queue.put(heuristic_mongo_document)
+
+        generators = [run_stage(generate_stage) for _ in range(min(self.n_workers, len(samples)))]
+        builders = [run_stage(build_stage) for _ in self.interfaces]
+        evaluators = [run_stage(eval_stage) for _ in self.interfaces]
+
+        # results are written from this thread as they finish; resume still works per (iter, _sample)
+        for _ in range(len(samples)):
+            item = done_queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            self.write(item)
+
+        for thread in generators:
+            thread.join()
+        for stage_queue, threads in ((build_queue, builders), (eval_queue, evaluators)):
+            for _ in threads:
+                stage_queue.put(None)
+            for thread in threads:
+                thread.join()
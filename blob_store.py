@@ -0,0 +1,156 @@
+import argparse
+import hashlib
+import os
+import zlib
+
+class LocalBlobStore:
+    """
+    Content-addressed directory of zlib-compressed text blobs.
+    """
+    kind = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_id: str) -> str:
+        return os.path.join(self.root, blob_id[:2], f"{blob_id}.z")
+
+    def put(self, blob_id: str, data: bytes):
+        path = self.path(blob_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(data))
+        os.replace(tmp_path, path)
+
+    def get(self, blob_id: str) -> bytes:
+        with open(self.path(blob_id), "rb") as f:
+            return zlib.decompress(f.read())
+
+class GridFSBlobStore:
+    """
+    The same, in a GridFS bucket of the run's database, so blobs live next to the documents.
+    """
+    kind = "gridfs"
+
+    def __init__(self, db, bucket: str = "blobs"):
+        import gridfs
+        from pymongo.errors import DuplicateKeyError
+        self.fs = gridfs.GridFS(db, collection=bucket)
+        self.already_stored = (gridfs.errors.FileExists, DuplicateKeyError)
+
+    def put(self, blob_id: str, data: bytes):
+        # blobs are content-addressed, so a blob some other worker stored first is the same blob
+        try:
+            self.fs.put(zlib.compress(data), _id=blob_id)
+        except self.already_stored:
+            pass
+
+    def get(self, blob_id: str) -> bytes:
+        return zlib.decompress(self.fs.get(blob_id).read())
+
+def open_blob_store(spec: str, db):
+    """
+    "gridfs" or a directory path.
+    """
+    if spec == "gridfs":
+        return GridFSBlobStore(db)
+    return LocalBlobStore(spec)
+
+def is_blob_ref(value) -> bool:
+    return isinstance(value, dict) and "_blob" in value
+
+def offload(value, store, threshold: int = 4096, preview_chars: int = 512):
+    """
+    Returns value with every string longer than threshold (in nested dicts/lists) moved to the
+    store and replaced by a reference that keeps a preview of its beginning.
+    """
+    if isinstance(value, str) and len(value) > threshold:
+        data = value.encode()
+        blob_id = hashlib.sha256(data).hexdigest()
+        store.put(blob_id, data)
+        return {"_blob": blob_id, "store": store.kind, "size": len(value), "preview": value[:preview_chars]}
+    if isinstance(value, dict) and not is_blob_ref(value):
+        return {k: offload(v, store, threshold, preview_chars) for k, v in value.items()}
+    if isinstance(value, list):
+        return [offload(v, store, threshold, preview_chars) for v in value]
+    return value
+
+def resolve(value, store):
+    """
+    Inverse of offload: fetches the full text of every reference in value.
+    """
+    if is_blob_ref(value):
+        return store.get(value["_blob"]).decode()
+    if isinstance(value, dict):
+        return {k: resolve(v, store) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, store) for v in value]
+    return value
+
+# fields of heuristic documents that hold logs rather than anything the search reads back
+REVISION_LOG_FIELDS = ["stdout", "stderr", "full_response"]
+
+def offload_document(heuristic_mongo_document, store, threshold: int = 4096, preview_chars: int = 512):
+    """
+    Offloads the logs of a heuristic document in place: stdout/stderr/full_response of every revision
+    and all of eval_logs. Code, scores and eval_results stay inline.
+    """
+    for revision in heuristic_mongo_document.get("revisions", []):
+        for field in REVISION_LOG_FIELDS:
+            if field in revision:
+                revision[field] = offload(revision[field], store, threshold, preview_chars)
+    if heuristic_mongo_document.get("eval_logs") is not None:
+        heuristic_mongo_document["eval_logs"] = offload(heuristic_mongo_document["eval_logs"], store, threshold, preview_chars)
+    return heuristic_mongo_document
+
+def has_blob_refs(value) -> bool:
+    if is_blob_ref(value):
+        return True
+    if isinstance(value, dict):
+        return any(has_blob_refs(v) for v in value.values())
+    if isinstance(value, list):
+        return any(has_blob_refs(v) for v in value)
+    return False
+
+def resolve_document(heuristic_mongo_document, store):
+    """
+    Inverse of offload_document, for readers of stored documents: fetches the offloaded logs back
+    in place. Fails on offloaded logs without a store rather than handing out references.
+    """
+    for field in ["revisions", "eval_logs"]:
+        value = heuristic_mongo_document.get(field)
+        if not has_blob_refs(value):
+            continue
+        if store is None:
+            raise ValueError(f"{field} of document {heuristic_mongo_document.get('_id')} is in a blob store; pass the run's --blob_store")
+        heuristic_mongo_document[field] = resolve(value, store)
+    return heuristic_mongo_document
+
+def offload_collection(collection, store, threshold: int = 4096, preview_chars: int = 512):
+    """
+    Offloads the logs of documents written before blob offloading was turned on.
+    """
+    n = 0
+    for doc in collection.find({"revisions": {"$exists": True}}, {"revisions": 1, "eval_logs": 1}):
+        offload_document(doc, store, threshold, preview_chars)
+        collection.update_one({"_id": doc["_id"]}, {"$set": {"revisions": doc["revisions"], "eval_logs": doc.get("eval_logs")}})
+        n += 1
+    return n
+
+if __name__ == "__main__":
+    from pymongo import MongoClient
+    from api_key import MONGO_CONNECTION_STRING
+
+    parser = argparse.ArgumentParser(description="Move the logs of an existing run into a blob store")
+    parser.add_argument("--collection_id", type=str, required=True, help="MongoDB collection of the run")
+    parser.add_argument("--blob_store", type=str, required=True, help="\"gridfs\" or a directory")
+    parser.add_argument("--blob_threshold", type=int, default=4096, help="Strings longer than this (in characters) are offloaded")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_CONNECTION_STRING)["policysmith"]
+    n = offload_collection(db[args.collection_id], open_blob_store(args.blob_store, db), args.blob_threshold)
+    print(f"Offloaded logs of {n} documents")
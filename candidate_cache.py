@@ -0,0 +1,28 @@
+import json
+
+from utils import code_hash
+
+class CandidateCache:
+    """
+    Build and evaluation results keyed by a hash of the normalized candidate code and the task
+    arguments. It lives in its own MongoDB collection, so a duplicate candidate reuses stored
+    results both within a run and across collections of the same task configuration.
+
+    Entries are only written once they are final: a failed build, or a build plus its evaluation.
+    """
+    def __init__(self, collection, task_name: str, task_args):
+        self.collection = collection
+        self.salt = json.dumps({"task": task_name, "task_args": task_args}, sort_keys=True, default=str)
+
+    def key(self, code: str) -> str:
+        return code_hash(code, salt=self.salt)
+
+    def lookup(self, key: str):
+        return self.collection.find_one({"_id": key})
+
+    def store(self, key: str, code: str, **results):
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"code": code, **results}},
+            upsert=True
+        )
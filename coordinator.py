@@ -0,0 +1,241 @@
+import argparse
+import datetime
+import os
+import socket
+import threading
+import time
+
+from pymongo import MongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from api_key import MONGO_CONNECTION_STRING
+from EvolveRunner import EvolutionRunner, START_TIME, ensure_sample_index
+
+PENDING, LEASED, DONE = "pending", "leased", "done"
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+class JobQueue:
+    """
+    The (iter, _sample) jobs of one collection, in the shared "jobs" collection. Workers claim a
+    job with an atomic find_one_and_update that sets a lease; a worker that stops heartbeating
+    loses its lease once it expires, and the job is claimed again by the next worker that asks.
+    """
+    def __init__(self, db, collection_id: str):
+        self.jobs = db["jobs"]
+        self.collection_id = collection_id
+        self.jobs.create_index([("collection_id", ASCENDING), ("iter", ASCENDING), ("state", ASCENDING)])
+
+    def job_id(self, _iter, _sample):
+        return f"{self.collection_id}:{_iter}:{_sample}"
+
+    def seed(self, _iter, n_samples, completed):
+        """
+        Adds the jobs of an iteration; samples already in the collection are added as done.
+        Jobs that already exist are left alone, so seeding again after a restart is harmless.
+        """
+        for _sample in range(n_samples):
+            self.jobs.update_one(
+                {"_id": self.job_id(_iter, _sample)},
+                {"$setOnInsert": {
+                    "collection_id": self.collection_id, "iter": _iter, "_sample": _sample,
+                    "state": DONE if _sample in completed else PENDING,
+                    "owner": None, "lease_expires": None, "attempts": 0
+                }},
+                upsert=True
+            )
+
+    def claim(self, _iter, owner: str, lease_seconds: float):
+        now = utcnow()
+        return self.jobs.find_one_and_update(
+            {
+                "collection_id": self.collection_id, "iter": _iter,
+                "$or": [{"state": PENDING}, {"state": LEASED, "lease_expires": {"$lt": now}}]
+            },
+            {
+                "$set": {"state": LEASED, "owner": owner, "lease_expires": now + datetime.timedelta(seconds=lease_seconds)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("_sample", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def heartbeat(self, job, owner: str, lease_seconds: float) -> bool:
+        """
+        Extends the lease. Returns False if the job is no longer leased to owner.
+        """
+        result = self.jobs.update_one(
+            {"_id": job["_id"], "state": LEASED, "owner": owner},
+            {"$set": {"lease_expires": utcnow() + datetime.timedelta(seconds=lease_seconds)}}
+        )
+        return result.matched_count == 1
+
+    def complete(self, job, owner: str) -> bool:
+        result = self.jobs.update_one(
+            {"_id": job["_id"], "state": LEASED, "owner": owner},
+            {"$set": {"state": DONE, "lease_expires": None}}
+        )
+        return result.matched_count == 1
+
+    def counts(self, _iter):
+        counts = {PENDING: 0, LEASED: 0, DONE: 0}
+        for group in self.jobs.aggregate([
+            {"$match": {"collection_id": self.collection_id, "iter": _iter}},
+            {"$group": {"_id": "$state", "n": {"$sum": 1}}}
+        ]):
+            counts[group["_id"]] = group["n"]
+        return counts
+
+    def seeded(self, _iter) -> bool:
+        return sum(self.counts(_iter).values()) > 0
+
+    def finished(self, _iter) -> bool:
+        counts = self.counts(_iter)
+        return counts[PENDING] == 0 and counts[LEASED] == 0 and counts[DONE] > 0
+
+class Heartbeat:
+    """
+    Keeps a lease alive from a background thread while a job runs.
+    """
+    def __init__(self, queue: JobQueue, job, owner: str, lease_seconds: float):
+        self.queue = queue
+        self.job = job
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            if not self.queue.heartbeat(self.job, self.owner, self.lease_seconds):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+class LeaseWorker(EvolutionRunner):
+    """
+    An EvolutionRunner that takes its samples from a JobQueue instead of owning the iteration, so
+    any number of workers (on any number of hosts) can share a collection. A worker only moves on
+    once every job of the iteration is done, then reloads the parents from MongoDB, so all
+    workers mutate the same programs.
+    """
+    def __init__(self, *args, lease_seconds: float = 300, poll_seconds: float = 10, worker_id=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert self.n_workers == 1 and not self.race, "lease workers run one sample at a time; start more workers instead"
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.jobs = JobQueue(self.db, self.collection_id)
+
+    def wait_until(self, condition, message):
+        while not condition():
+            print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} waiting: {message}")
+            time.sleep(self.poll_seconds)
+
+    def evolve(self):
+        for _iter in range(self.start_iter_idx, self.end_iter_idx):
+            if _iter > 0:
+                # other workers wrote most of the previous iteration; pick parents from MongoDB
+                self.leaderboard.loaded = False
+                self.get_priority_programs(_iter - 1)
+            self.wait_until(lambda: self.jobs.seeded(_iter), f"coordinator to seed iter={_iter}")
+            self.finish_iteration(_iter)
+
+    def finish_iteration(self, _iter):
+        """
+        Runs jobs of the iteration until all of them are done. This is the barrier before the next
+        iteration: while waiting, a worker keeps claiming, so the job of a worker that died is
+        reclaimed once its lease expires instead of blocking everyone.
+        """
+        while not self.jobs.finished(_iter):
+            job = self.jobs.claim(_iter, self.worker_id, self.lease_seconds)
+            if job is None:
+                print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} waiting: iter={_iter} to finish")
+                time.sleep(self.poll_seconds)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        _iter, _sample = job["iter"], job["_sample"]
+        if job["attempts"] > 1:
+            print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} reclaimed iter={_iter}; sample={_sample} (attempt {job['attempts']})")
+            # its previous worker may have died after writing the document but before completing the job
+            if self.db[self.collection_id].find_one({"iter": _iter, "_sample": _sample}, {"_id": 1}) is not None:
+                print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} found iter={_iter}; sample={_sample} already written")
+                self.jobs.complete(job, self.worker_id)
+                return
+        with Heartbeat(self.jobs, job, self.worker_id, self.lease_seconds) as heartbeat:
+            heuristic_mongo_document, llm_chat, llm_response = self.generate(_iter, _sample)
+            heuristic_mongo_document["worker"] = self.worker_id
+            if self.build(self.interface, heuristic_mongo_document, llm_chat, llm_response):
+                self.evaluate(self.interface, heuristic_mongo_document)
+        # a worker whose lease expired mid-job leaves the sample to whoever reclaimed it
+        if heartbeat.lost or not self.jobs.heartbeat(job, self.worker_id, self.lease_seconds):
+            print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} lost the lease on iter={_iter}; sample={_sample}, dropping it")
+            return
+        self.write(heuristic_mongo_document)
+        self.jobs.complete(job, self.worker_id)
+
+    def store(self, heuristic_mongo_document):
+        """
+        Writes the document only if none exists for its (iter, _sample), so a reclaimed job never
+        produces a second one. Two workers finishing it at the same time can both try to insert;
+        the unique index (see ensure_sample_index) lets only one of them succeed.
+        """
+        try:
+            result = self.db[self.collection_id].update_one(
+                {"iter": heuristic_mongo_document["iter"], "_sample": heuristic_mongo_document["_sample"]},
+                {"$setOnInsert": heuristic_mongo_document},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            result = None
+        if result is None or result.upserted_id is None:
+            print(f"[{round(time.time()-START_TIME, 2)}] {self.worker_id} found iter={heuristic_mongo_document['iter']}; sample={heuristic_mongo_document['_sample']} already written, not writing it again")
+            return False
+        heuristic_mongo_document["_id"] = result.upserted_id
+        return True
+
+def coordinate(db, collection_id, n_samples, start_iter_idx, end_iter_idx, poll_seconds=30):
+    """
+    Seeds the jobs of every iteration and reports progress until all are done. Workers do the
+    rest (including reclaiming expired leases), so the coordinator can be restarted at any time.
+    """
+    jobs = JobQueue(db, collection_id)
+    collection = db[collection_id]
+    ensure_sample_index(collection)
+    for _iter in range(start_iter_idx, end_iter_idx):
+        completed = {record["_sample"] for record in collection.find({"iter": _iter}, {"_sample": 1})}
+        jobs.seed(_iter, n_samples, completed)
+    print(f"[{round(time.time()-START_TIME, 2)}] Seeded iters {start_iter_idx}..{end_iter_idx - 1} of {collection_id}, {n_samples} samples each")
+
+    for _iter in range(start_iter_idx, end_iter_idx):
+        while not jobs.finished(_iter):
+            counts = jobs.counts(_iter)
+            expired = jobs.jobs.count_documents({"collection_id": collection_id, "iter": _iter, "state": LEASED, "lease_expires": {"$lt": utcnow()}})
+            print(f"[{round(time.time()-START_TIME, 2)}] iter={_iter}: {counts[DONE]} done, {counts[LEASED]} leased ({expired} expired), {counts[PENDING]} pending")
+            time.sleep(poll_seconds)
+        print(f"[{round(time.time()-START_TIME, 2)}] iter={_iter} finished")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed and monitor the jobs of a multi-worker run (workers: test_evolve.py --worker)")
+    parser.add_argument("--collection_id", type=str, required=True, help="MongoDB collection of the run (created if it does not exist)")
+    parser.add_argument("--n_samples", type=int, default=25, help="How many samples per iteration of evolution?")
+    parser.add_argument("--start_iter_idx", type=int, default=0, help="Start iteration index")
+    parser.add_argument("--end_iter_idx", type=int, default=1, help="End iteration index")
+    parser.add_argument("--poll_seconds", type=float, default=30, help="How often to report progress")
+    args = parser.parse_args()
+
+    db = MongoClient(MONGO_CONNECTION_STRING)["policysmith"]
+    if args.collection_id not in db.list_collection_names():
+        db.create_collection(args.collection_id)
+    coordinate(db, args.collection_id, args.n_samples, args.start_iter_idx, args.end_iter_idx, args.poll_seconds)
@@ -1,7 +1,12 @@
 import argparse
+import os
+import sys
 import pymongo
 from bson import ObjectId
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blob_store import open_blob_store, resolve_document
+
 heuristic_mapping = {
     "PS-A": '686aea309ba953162c4e686c',
     "PS-B": '686a908665614c43f2c8d803',
@@ -16,6 +21,8 @@ heuristic_mapping = {
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process heuristic names.")
     parser.add_argument('heuristic_name', type=str, help='Name of the heuristic', choices=list(heuristic_mapping.keys()))
+    parser.add_argument('--logs', action='store_true', help='Also print the LLM responses and build logs of every revision')
+    parser.add_argument('--blob_store', type=str, default=None, help='"gridfs" or the directory the run offloaded its logs to (--blob_store of test_evolve.py)')
     args = parser.parse_args()
     args.heuristic_id = heuristic_mapping[args.heuristic_name]
 
@@ -24,4 +31,10 @@ if __name__ == "__main__":
     db = client["policysmith"]
     result = db[args.heuristic_name].find_one({ "_id": ObjectId(args.heuristic_id) })
 
-    print(result['final_code'])
\ No newline at end of file
+    print(result['final_code'])
+    if args.logs:
+        resolve_document(result, open_blob_store(args.blob_store, db) if args.blob_store is not None else None)
+        for i, revision in enumerate(result.get('revisions', [])):
+            for field in ['full_response', 'stdout', 'stderr']:
+                if revision.get(field):
+                    print(f"\n===== revision {i}: {field} =====\n{revision[field]}")
\ No newline at end of file
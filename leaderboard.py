@@ -0,0 +1,62 @@
+import bisect
+
+from pymongo import ASCENDING, DESCENDING
+
+class Leaderboard:
+    """
+    Keeps the top-k programs of a collection by eval_results.score in memory. It is seeded
+    once with an indexed, projected query and then updated as documents are written, so
+    picking parents does not depend on how large the collection has grown.
+    """
+    PROJECTION = {"final_code": 1, "iter": 1, "eval_results.score": 1}
+
+    def __init__(self, collection, k: int):
+        self.collection = collection
+        self.k = k
+        self.loaded = False
+        self.entries = [] # sorted by descending score, at most k long
+        self.collection.create_index([
+            ("build_status", ASCENDING),
+            ("exec_status", ASCENDING),
+            ("eval_results.score", DESCENDING)
+        ])
+
+    def load(self, iter_num: int):
+        """
+        Replaces the in-memory leaderboard with the top-k valid programs up to iter_num.
+        """
+        cursor = self.collection.find(
+            {"build_status": True, "exec_status": True, "iter": {"$lte": iter_num}, "eval_results.partial": {"$ne": True}},
+            self.PROJECTION
+        ).sort("eval_results.score", DESCENDING).limit(self.k)
+        self.entries = [self.to_entry(doc) for doc in cursor]
+        self.loaded = True
+
+    def offer(self, doc):
+        """
+        Adds a newly written (or already stored) document if it makes the top-k.
+        """
+        if not (doc.get("build_status") and doc.get("exec_status")):
+            return
+        if doc["eval_results"].get("partial", False):
+            # racing losers only ran on a trace prefix; their scores are not comparable
+            return
+        entry = self.to_entry(doc)
+        if len(self.entries) == self.k and entry["score"] <= self.entries[-1]["score"]:
+            return
+        # equal scores keep their arrival order, like the stable sort this replaces
+        idx = bisect.bisect_right([-e["score"] for e in self.entries], -entry["score"])
+        self.entries.insert(idx, entry)
+        del self.entries[self.k:]
+
+    def top(self):
+        return self.entries
+
+    @staticmethod
+    def to_entry(doc):
+        return {
+            "_id": doc.get("_id"),
+            "iter": doc["iter"],
+            "final_code": doc["final_code"],
+            "score": doc["eval_results"]["score"]
+        }
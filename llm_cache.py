@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+
+class ReplayMissError(KeyError):
+    pass
+
+class ResponseCache:
+    """
+    Content-addressed, size-bounded store of LLM responses on disk. Entries are keyed by the
+    model, the chat (e.g. the sample it generates), the conversation so far and the new prompt,
+    so a rerun that asks the same questions gets the same answers back without calling the
+    provider, while samples that ask the same question still get answers of their own. With replay_only=True, a miss
+    raises ReplayMissError instead of falling through to the provider.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = None, replay_only: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.replay_only = replay_only
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = sum(os.path.getsize(path) for path in self.entries())
+
+    @staticmethod
+    def key(model_name, chat_id, history, message) -> str:
+        payload = json.dumps({"model": model_name, "chat": chat_id, "history": history, "prompt": message}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    yield os.path.join(root, name)
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path) # mtime doubles as the LRU clock
+        except FileNotFoundError:
+            # never stored, or evicted (possibly by another process) since
+            with self.lock:
+                self.misses += 1
+            if self.replay_only:
+                raise ReplayMissError(f"No recorded LLM response for key {key} (replay-only mode)")
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            # an entry replaced under the same key no longer counts
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self.total_bytes += size
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # drop least recently used entries until we are 10% under the bound
+        files = sorted(self.entries(), key=os.path.getmtime)
+        self.total_bytes = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.total_bytes
+            }
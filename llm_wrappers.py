@@ -1,21 +1,62 @@
+import asyncio
 import re
+import threading
+import weakref
 
 from abc import ABC, abstractmethod
 from types import SimpleNamespace
 
 from google import genai
-from openai import OpenAI
+from google.genai import types
+from openai import AsyncOpenAI, OpenAI
 
 from api_key import GEMINI_API_KEY, OPENAI_API_KEY
 
+# Provider clients are created once per process and shared by every chat, so new chats
+# reuse the connection pool instead of paying for client setup and handshakes again.
+_POOL_LOCK = threading.Lock()
+_CLIENTS = {}
+# async clients own connections bound to an event loop, so they are pooled per loop
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+def pooled_client(name, factory):
+    with _POOL_LOCK:
+        if name not in _CLIENTS:
+            _CLIENTS[name] = factory()
+        return _CLIENTS[name]
+
+def pooled_async_client(name, factory):
+    loop = asyncio.get_running_loop()
+    with _POOL_LOCK:
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        if name not in clients:
+            clients[name] = factory()
+        return clients[name]
+
 class LLMWrapper(ABC):
     def __init__(self, model_name):
         self.model_name = model_name
-        assert self.model_name in ALL_LLM_MODELS.keys()
+        assert self.model_name in [model_key for model_key, _ in ALL_LLM_MODELS.values()]
+        self.cache = None
+        # tells apart chats that ask the same questions (e.g. the samples of one iteration) in the cache
+        self.chat_id = None
+        # (prompt, response) pairs of this chat; also what the response cache is keyed on
+        self.history = []
+        # False once turns have been served from the cache that the provider has not seen
+        self.provider_in_sync = True
 
     @abstractmethod
     def _send(self, message):
         pass
+
+    @abstractmethod
+    async def _asend(self, message):
+        pass
+
+    @abstractmethod
+    def _resync(self):
+        # rebuild provider-side chat state from self.history before the next _send/_asend
+        pass
     
     @abstractmethod
     def _stats(self):
@@ -23,12 +64,48 @@ class LLMWrapper(ABC):
         #       - prompt_tokens: what was the prompt size (including all previous messages)
         #       - gen_tokens: how many tokens were generated in response
         pass
+
+    def _cache_lookup(self, message):
+        if self.cache is None:
+            return None, None
+        key = self.cache.key(self.model_name, self.chat_id, self.history, message)
+        return key, self.cache.get(key)
+
+    def _record(self, key, message, raw_response, stats, cached):
+        if cached:
+            self.provider_in_sync = False
+        elif self.cache is not None:
+            self.cache.put(key, {"model": self.model_name, "response": raw_response, "stats": stats})
+        self.history.append([message, raw_response])
+        return self.split_explanation_and_code(raw_response, {**stats, "cached": cached})
     
     def send_message(self, message):
+        key, entry = self._cache_lookup(message)
+        if entry is not None:
+            return self._record(key, message, entry["response"], entry["stats"], cached=True)
+
+        if not self.provider_in_sync:
+            self._resync()
+            self.provider_in_sync = True
         raw_response = self._send(message)
-        return self.split_explanation_and_code(raw_response)
+        return self._record(key, message, raw_response, self._stats(), cached=False)
 
-    def split_explanation_and_code(self, llm_output):
+    async def asend_message(self, message):
+        """
+        asyncio version of send_message. Chat state lives on the wrapper, so many wrappers can
+        have requests in flight at once; a single wrapper should stick to either sync or async.
+        """
+        key, entry = self._cache_lookup(message)
+        if entry is not None:
+            return self._record(key, message, entry["response"], entry["stats"], cached=True)
+
+        if not self.provider_in_sync:
+            self._resync()
+            self.provider_in_sync = True
+        raw_response = await self._asend(message)
+        return self._record(key, message, raw_response, self._stats(), cached=False)
+
+    def split_explanation_and_code(self, llm_output, stats):
         """
         Splits LLM output into plaintext and code segments.
         """
@@ -58,18 +135,38 @@ class LLMWrapper(ABC):
             "text_segs": plaintext_segments,
             "code_segs": code_segments,
             "code_langs": code_languages,
-            "stats": self._stats()
+            "stats": stats
         }
 
 class GeminiWrapper(LLMWrapper):
     def __init__(self, model_name):
-        self.client = genai.Client(api_key=GEMINI_API_KEY)
-        self.chat = self.client.chats.create(model=model_name)
+        super().__init__(model_name)
+        self.client = pooled_client("gemini", lambda: genai.Client(api_key=GEMINI_API_KEY))
+        self.chat = None
         self.responses = []
 
+    def _chat_history(self):
+        contents = []
+        for prompt, response in self.history:
+            contents.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
+            contents.append(types.Content(role="model", parts=[types.Part(text=response)]))
+        return contents
+
+    def _resync(self):
+        self.chat = None # recreated with the full history on the next send
+
     def _send(self, message):
+        if self.chat is None:
+            self.chat = self.client.chats.create(model=self.model_name, history=self._chat_history())
         self.responses.append(self.chat.send_message(message))
         return self.responses[-1].text
+
+    async def _asend(self, message):
+        if self.chat is None:
+            aio_client = pooled_async_client("gemini", lambda: genai.Client(api_key=GEMINI_API_KEY).aio)
+            self.chat = aio_client.chats.create(model=self.model_name, history=self._chat_history())
+        self.responses.append(await self.chat.send_message(message))
+        return self.responses[-1].text
     
     def _stats(self):
         return {
@@ -79,18 +176,39 @@ class GeminiWrapper(LLMWrapper):
 
 class OpenAIWrapper(LLMWrapper):
     def __init__(self, model_name):
-        self.model_name = model_name
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        super().__init__(model_name)
+        self.client = pooled_client("openai", lambda: OpenAI(api_key=OPENAI_API_KEY))
         self.responses = []
-    
+        self.resend_history = False
+
+    def _resync(self):
+        self.resend_history = True
+
+    def _request(self, message):
+        if self.resend_history:
+            # some turns came from the cache, so there is no server-side response chain to continue
+            self.resend_history = False
+            turns = []
+            for prompt, response in self.history:
+                turns.append({"role": "user", "content": prompt})
+                turns.append({"role": "assistant", "content": response})
+            return {
+                "model": self.model_name,
+                "input": turns + [{"role": "user", "content": message}]
+            }
+        return {
+            "model": self.model_name,
+            "previous_response_id": self.responses[-1].id if len(self.responses) > 0 else None,
+            "input": [{"role": "user", "content": message}]
+        }
+
     def _send(self, message):
-        self.responses.append(
-            self.client.responses.create(
-                model=self.model_name,
-                previous_response_id=self.responses[-1].id if len(self.responses) > 0 else None,
-                input=[{"role": "user", "content": message}]
-            )
-        )
+        self.responses.append(self.client.responses.create(**self._request(message)))
+        return self.responses[-1].output[0].content[0].text
+
+    async def _asend(self, message):
+        aio_client = pooled_async_client("openai", lambda: AsyncOpenAI(api_key=OPENAI_API_KEY))
+        self.responses.append(await aio_client.responses.create(**self._request(message)))
         return self.responses[-1].output[0].content[0].text
     
     def _stats(self):
@@ -106,9 +224,12 @@ ALL_LLM_MODELS = {
     "gpt-4o-mini": ("gpt-4o-mini", OpenAIWrapper)
 }
 
-def get_wrapper(model_name):
+def get_wrapper(model_name, cache=None, chat_id=None):
     if model_name not in ALL_LLM_MODELS:
         raise ValueError(f"Model {model_name} is not supported.")
     
     model_key, wrapper_class = ALL_LLM_MODELS[model_name]
-    return wrapper_class(model_key)
\ No newline at end of file
+    wrapper = wrapper_class(model_key)
+    wrapper.cache = cache
+    wrapper.chat_id = chat_id
+    return wrapper
\ No newline at end of file
@@ -0,0 +1,282 @@
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# values of eval_logs["failure_reason"] (and exec_failure_reason on heuristic documents)
+WALL_TIME_LIMIT = "wall_time_limit"
+CPU_TIME_LIMIT = "cpu_time_limit"
+MEMORY_LIMIT = "memory_limit"
+NONZERO_EXIT = "nonzero_exit"
+
+OUT_OF_MEMORY_MESSAGES = ["std::bad_alloc", "Cannot allocate memory", "failed to allocate", "MemoryError"]
+
+def create_cgroup(mem_bytes=None):
+    """
+    Creates a cgroup v2 child of our own cgroup, with memory.max set if mem_bytes is given. Returns
+    its path, or None if cgroups are not writable for this user (rlimits still apply in that case).
+    """
+    try:
+        with open("/proc/self/cgroup") as f:
+            own = [line.strip().split("::", 1)[1] for line in f if line.startswith("0::")][0]
+        path = os.path.join(CGROUP_ROOT, own.lstrip("/"), f"policysmith_{uuid.uuid4().hex[:12]}")
+        os.mkdir(path)
+        if not os.path.exists(os.path.join(path, "cgroup.procs")):
+            # not a cgroup v2 hierarchy (e.g. a tmpfs under a v1 setup)
+            os.rmdir(path)
+            return None
+        if mem_bytes is None:
+            return path
+        with open(os.path.join(path, "memory.max"), "w") as f:
+            f.write(str(mem_bytes))
+        if os.path.exists(os.path.join(path, "memory.swap.max")):
+            with open(os.path.join(path, "memory.swap.max"), "w") as f:
+                f.write("0")
+        return path
+    except (OSError, IndexError):
+        return None
+
+def cgroup_oom_killed(path):
+    try:
+        with open(os.path.join(path, "memory.events")) as f:
+            return any(line.startswith("oom_kill ") and int(line.split()[1]) > 0 for line in f)
+    except OSError:
+        return False
+
+def remove_cgroup(path):
+    try:
+        with open(os.path.join(path, "cgroup.procs")) as f:
+            for pid in f.read().split():
+                os.kill(int(pid), signal.SIGKILL)
+        os.rmdir(path)
+    except OSError:
+        pass
+
+def cgroup_procs(path):
+    try:
+        with open(os.path.join(path, "cgroup.procs")) as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+def descendants(pids):
+    """
+    All live descendants of pids, found through the parent pids in /proc. Unlike a process group,
+    this also follows children that started their own session (e.g. sudo with use_pty).
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may contain spaces; fields after it are space separated
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    stack = list(pids)
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+def kill_pids(pids, sig=signal.SIGKILL, groups=False):
+    """
+    Signals pids (or the process groups with these ids), falling back to sudo for processes of
+    other users (e.g. started with sudo).
+    """
+    foreign = []
+    for pid in pids:
+        try:
+            if groups:
+                os.killpg(pid, sig)
+            else:
+                os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            foreign.append(f"-{pid}" if groups else str(pid))
+    if foreign:
+        subprocess.run(f"sudo -n kill -{int(sig)} -- {' '.join(foreign)}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def limit_commands(cpu_seconds=None, as_bytes=None):
+    # rlimits the shell sets for itself, and so for everything it starts
+    limits = []
+    if cpu_seconds is not None:
+        # SIGXCPU at the soft limit, SIGKILL a second later
+        limits.append(f"ulimit -S -t {int(cpu_seconds)}")
+        limits.append(f"ulimit -H -t {int(cpu_seconds) + 1}")
+    if as_bytes is not None:
+        limits.append(f"ulimit -v {int(as_bytes) // 1024}")
+    return limits
+
+def spawn(cmd, cgroup=None, cpu_seconds=None, as_bytes=None):
+    """
+    Starts a shell command in a new session, with stdout and stderr piped. Nothing runs in the
+    forked child before exec (a preexec_fn is not safe while other threads run): the rlimits
+    are set by the shell itself, and the parent moves the shell into cgroup. Until it has, the
+    shell waits on its stdin, so everything cmd starts is in the cgroup; cmd then reads /dev/null.
+    """
+    steps = limit_commands(cpu_seconds, as_bytes)
+    gate = release = None
+    if cgroup is not None:
+        gate, release = os.pipe()
+        steps = ["read _"] + steps
+    if steps:
+        cmd = " && ".join(steps + [f"exec sh -c {shlex.quote(cmd)}" + (" </dev/null" if cgroup is not None else "")])
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=gate,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+    finally:
+        if gate is not None:
+            os.close(gate)
+    if cgroup is not None:
+        try:
+            with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+                f.write(str(proc.pid))
+        except OSError:
+            pass # runs outside the cgroup, as when cgroups are not writable
+        try:
+            os.write(release, b"\n")
+        except OSError:
+            pass # the shell is already gone
+        os.close(release)
+    return proc
+
+class ProcessScope:
+    """
+    The processes of one evaluation. Every command is started in its own process group (and in
+    a cgroup of the scope, when cgroups are writable), so teardown signals exactly the processes
+    the evaluation started and their descendants, never other processes with the same name.
+    """
+    def __init__(self):
+        self.cgroup = create_cgroup()
+        self.procs = []
+        self.lock = threading.Lock()
+
+    def popen(self, cmd):
+        proc = spawn(cmd, cgroup=self.cgroup)
+        with self.lock:
+            self.procs.append(proc)
+        return proc
+
+    def tree(self, proc):
+        return [proc.pid] + descendants([proc.pid])
+
+    def stop(self, proc, grace_seconds=5, sig=signal.SIGINT):
+        """
+        Sends sig to proc and its descendants, waits up to grace_seconds for it to exit, then
+        kills whatever of its tree is left. Returns proc's (stdout, stderr).
+        """
+        tree = self.tree(proc)
+        kill_pids(tree, sig)
+        try:
+            outputs = proc.communicate(timeout=grace_seconds)
+        except subprocess.TimeoutExpired:
+            outputs = None
+        # whatever of the tree outlived proc (e.g. orphaned background jobs) goes too
+        kill_pids(self.tree(proc) + tree)
+        kill_pids([proc.pid], groups=True)
+        return outputs if outputs is not None else proc.communicate()
+
+    def close(self):
+        """
+        Kills every remaining process of the scope and removes its cgroup. Returns the seconds it took.
+        """
+        start = time.time()
+        with self.lock:
+            procs, self.procs = self.procs, []
+        pids = [proc.pid for proc in procs if proc.poll() is None] + descendants([proc.pid for proc in procs])
+        # orphans re-parented away from our processes are found through their process group,
+        # or through the cgroup if they also left that
+        if self.cgroup is not None:
+            pids += cgroup_procs(self.cgroup)
+        kill_pids(set(pids))
+        kill_pids([proc.pid for proc in procs], groups=True)
+        for proc in procs:
+            try:
+                proc.communicate(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        if self.cgroup is not None:
+            deadline = time.time() + 5
+            while cgroup_procs(self.cgroup) and time.time() < deadline:
+                time.sleep(0.05)
+            remove_cgroup(self.cgroup)
+            self.cgroup = None
+        return time.time() - start
+
+def exit_signal(returncode):
+    # Popen reports -SIG for the direct child; `sh -c` reports 128+SIG for the commands it runs
+    if returncode < 0:
+        return -returncode
+    if returncode > 128:
+        return returncode - 128
+    return None
+
+def classify_failure(returncode, stderr, wall_seconds=None, cpu_seconds=None, mem_bytes=None, oom_killed=False):
+    """
+    Maps the exit status of a limited process to a failure reason (None on success). A SIGALRM
+    death counts as a wall-clock limit, for processes that enforce it themselves with alarm().
+    """
+    if returncode == 0:
+        return None
+    sig = exit_signal(returncode)
+    if wall_seconds is not None and sig == signal.SIGALRM:
+        return WALL_TIME_LIMIT
+    if cpu_seconds is not None and sig in (signal.SIGXCPU, signal.SIGKILL) and not oom_killed:
+        return CPU_TIME_LIMIT
+    if mem_bytes is not None and (oom_killed or any(m in stderr for m in OUT_OF_MEMORY_MESSAGES)):
+        return MEMORY_LIMIT
+    return NONZERO_EXIT
+
+def run_limited(cmd, wall_seconds=None, cpu_seconds=None, mem_bytes=None, mapped_bytes=0):
+    """
+    Runs a shell command in its own process group (see spawn) with optional wall-clock, CPU-time
+    (RLIMIT_CPU) and address-space (RLIMIT_AS, plus a cgroup memory.max when available) limits.
+    mapped_bytes is the size of files the command mmaps (e.g. a decompressed trace): RLIMIT_AS
+    counts those mappings, so they are added to its limit, while memory.max stays at mem_bytes.
+    Returns (returncode, stdout, stderr, failure_reason); failure_reason is None on success.
+    """
+    cgroup = create_cgroup(mem_bytes) if mem_bytes is not None else None
+    proc = spawn(
+        cmd,
+        cgroup=cgroup,
+        cpu_seconds=cpu_seconds,
+        as_bytes=mem_bytes + mapped_bytes if mem_bytes is not None else None
+    )
+    failure_reason = None
+    try:
+        stdout, stderr = proc.communicate(timeout=wall_seconds)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        stdout, stderr = proc.communicate()
+        failure_reason = WALL_TIME_LIMIT
+    finally:
+        # nothing the command started may outlive it
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if cgroup is not None:
+            oom_killed = cgroup_oom_killed(cgroup)
+            remove_cgroup(cgroup)
+
+    if failure_reason is None:
+        failure_reason = classify_failure(proc.returncode, stderr, cpu_seconds=cpu_seconds, mem_bytes=mem_bytes, oom_killed=cgroup is not None and oom_killed)
+    return proc.returncode, stdout, stderr, failure_reason
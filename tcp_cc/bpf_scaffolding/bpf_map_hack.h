@@ -7,17 +7,44 @@
 #include <linux/device.h>	/* Needed for device_create */
 #include <linux/uaccess.h>	/* Needed for copy_from_user */
 #include <linux/printk.h>	/* Needed for pr_info() */
+#include <linux/mutex.h>	/* Needed for cwnd_map_lock */
+#include <linux/rcupdate.h>	/* Needed for the RCU-protected cwnd_map */
 
 static dev_t dev = 0;                       // (MIRRORS: `dev` in fstore.c)
 static struct cdev cwnd_cdev;                // (MIRRORS: `fstore_cdev` in fstore.c)
 static struct class *dev_class;              // (MIRRORS: `dev_class` in fstore.c)
-struct bpf_map *cwnd_map = NULL;             // (REPLACES: `fstore_map` hash table) 
+struct bpf_map __rcu *cwnd_map = NULL;       // (REPLACES: `fstore_map` hash table) 
+static DEFINE_MUTEX(cwnd_map_lock);          // serializes writers; readers only use RCU
 
 enum cwnd_store_cmd {
     REGISTER_CWND = 0x0,
     UNREGISTER_CWND = 0x1,
+    UNREGISTER_CWND_IF = 0x2, /* unregister only if the given map is the registered one */
 };
 
+/* Atomically replaces the registered map (readers see either the old or the new one) and drops
+ * the reference to the old map once no reader can still be using it. With check_expected, nothing
+ * changes (and false is returned) unless expected is the registered map. */
+static bool swap_cwnd_map(struct bpf_map *map, struct bpf_map *expected, bool check_expected)
+{
+	struct bpf_map *old;
+
+	mutex_lock(&cwnd_map_lock);
+	old = rcu_dereference_protected(cwnd_map, lockdep_is_held(&cwnd_map_lock));
+	if (check_expected && old != expected) {
+		mutex_unlock(&cwnd_map_lock);
+		return false;
+	}
+	rcu_assign_pointer(cwnd_map, map);
+	mutex_unlock(&cwnd_map_lock);
+
+	if (old) {
+		synchronize_rcu();
+		bpf_map_put(old);
+	}
+	return true;
+}
+
 static long cwnd_ioctl(struct file *file,
 	unsigned int cmd,
 	unsigned long data)
@@ -41,17 +68,33 @@ static long cwnd_ioctl(struct file *file,
 				break;
 			}
 
-			if (cwnd_map) bpf_map_put(cwnd_map);
-			cwnd_map = map;
+			swap_cwnd_map(map, NULL, false);
 			pr_info("cwnd_store: Map registered successfully\n");
 			break;
 
 		case UNREGISTER_CWND:
-			if (cwnd_map) {
-				bpf_map_put(cwnd_map);
-				cwnd_map = NULL;
-				pr_info("cwnd_store: Map unregistered successfully\n");
+			swap_cwnd_map(NULL, NULL, false);
+			pr_info("cwnd_store: Map unregistered successfully\n");
+			break;
+
+		case UNREGISTER_CWND_IF:
+			/* a replaced probe must not unregister the map of the probe that replaced it */
+			if (copy_from_user(&fd, (int __user *)data, sizeof(fd))) {
+				pr_err("cwnd_store: Copying fd from user failed\n");
+				err = -EINVAL;
+				break;
+			}
+
+			map = bpf_map_get(fd);
+			if (IS_ERR(map)) {
+				pr_err("cwnd_store: bpf_map_get failed\n");
+				err = PTR_ERR(map);
+				break;
 			}
+
+			if (swap_cwnd_map(NULL, map, true))
+				pr_info("cwnd_store: Map unregistered successfully\n");
+			bpf_map_put(map);
 			break;
 
 		default:
@@ -116,10 +159,7 @@ void destroy_hack(void);
 void destroy_hack(void)
 {
 	/* Cleanup map if still registered */
-	if (cwnd_map) {
-		bpf_map_put(cwnd_map);
-		cwnd_map = NULL;
-	}
+	swap_cwnd_map(NULL, NULL, false);
 
 	/* Cleanup device */
 	device_destroy(dev_class, dev);
@@ -130,20 +170,21 @@ void destroy_hack(void)
 	pr_info("cwnd_store: Device unloaded\n");
 }
 
-static bool lookup_cwnd(u32 *out)
+/* cwnd_map is keyed by the flow's heuristic_state pointer, like the BPF program's updates */
+static bool lookup_cwnd(const void *flow, u32 *out)
 {
-	u32 key = 0;
-	void *value;
-	if (!cwnd_map) return false;
+	u64 key = (u64)(unsigned long)flow;
+	void *value = NULL;
+	struct bpf_map *map;
 
 	rcu_read_lock();
-	value = cwnd_map->ops->map_lookup_elem(cwnd_map, &key);
+	map = rcu_dereference(cwnd_map);
+	if (map) value = map->ops->map_lookup_elem(map, &key);
+	/* the value belongs to the map, so it is read before a swap can free it */
+	if (value) *out = *(u32*)value;
 	rcu_read_unlock();
 
-	if (!value) return false;
-
-	*out = *(u32*)value;
-	return true;
+	return value != NULL;
 }
 
 
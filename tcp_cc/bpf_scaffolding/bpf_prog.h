@@ -20,7 +20,9 @@ struct rate_sample {
     bool is_ack_delayed;	/* is this (likely) a delayed ACK? */
 };
 
-BPF_ARRAY(cwnd_map, u32, 1);
+// new cwnd per flow, keyed by the flow's heuristic_state pointer (what tcp_heuristic's lookup_cwnd uses),
+// so concurrent flows never read each other's value; LRU so closed flows age out
+BPF_TABLE("lru_hash", u64, u32, cwnd_map, 4096);
 BPF_PERCPU_ARRAY(bpf_arr_heuristic_state, struct heuristic_state, 1);
 BPF_PERCPU_ARRAY(bpf_arr_rate_sample, struct rate_sample, 1);
 
@@ -33,9 +35,10 @@ int bpf_heuristic_logic_wrapper(struct pt_regs *ctx) {
     u32 prev_cwnd = (u32)PT_REGS_PARM4(ctx);
 
     u32 key = 0;
+    u64 flow_key = (u64)st;
 
     // get old cwnd
-    u32 *old_val = cwnd_map.lookup(&key);
+    u32 *old_val = cwnd_map.lookup(&flow_key);
 
     // read BPF maps
     struct heuristic_state* st_copy = bpf_arr_heuristic_state.lookup(&key);
@@ -48,7 +51,7 @@ int bpf_heuristic_logic_wrapper(struct pt_regs *ctx) {
     u32 value = bpf_core_logic(ca_state, st_copy, rs_copy, prev_cwnd);
     
     // update cwnd
-    cwnd_map.update(&key, &value);
+    cwnd_map.update(&flow_key, &value);
     bpf_trace_printk("cwnd old=%d new=%d\\n", old_val ? *old_val : 0, value);
     return 0;
 }
\ No newline at end of file
@@ -1,41 +1,46 @@
 import argparse
+import atexit
 import json
 import os
+import shutil
 import signal
+import socket
 import subprocess
+import tempfile
 import time
 import textwrap
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 from Evolve import EvolveInterface
+from proc_utils import ProcessScope
+from tcp_cc.evaluate.utils import read_link_log
 from utils import cpp_comment_remover
 
-def parse_sum_file(lines):
-    utilization = 0
-    throughput = 0
-    queuing_delay_95p = 0
-    signal_delay_95p = 0
-
-    for line in lines:
-        if "utilization" in line:
-            utilization = float(line.split()[-2][1:-1])
-            throughput = float(line.split()[2])
-        if "95th percentile per-packet queueing delay" in line:
-            queuing_delay_95p = float(line.split()[-2])
-        if "95th percentile signal delay" in line:
-            signal_delay_95p = float(line.split()[-2])
-
-    return_dict = {
-        'utilization': utilization, 
-        'queuing_delay_95p': queuing_delay_95p, 
-        'signal_delay_95p': signal_delay_95p, 
-        'throughput': throughput
-    }
-    print(return_dict)
-    
-    return return_dict
+# scalar statistics of a link log stored as a trace's results
+LINK_LOG_STATS = [
+    'utilization', 'queuing_delay_95p', 'signal_delay_95p', 'throughput',
+    'capacity', 'queuing_delay_avg', 'queuing_delay_50p', 'queuing_delay_99p', 'drops'
+]
+
+# what a workspace needs to build the module and compile, pin and attach the BPF program
+SCAFFOLDING_FILES = ["Makefile", "logic.py", "bpf_prog.h", "bpf_map_hack.h", "tcp_heuristic.c", "tcp_heuristic.h"]
+
+def free_ports(n):
+    # ports nothing listens on right now (held open together so they differ), so concurrent
+    # evaluations on one host never share an iperf3 port
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(n)]
+    try:
+        for s in sockets:
+            s.bind(("", 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
 
 class CongestionControlBPF(EvolveInterface):
+    ISOLATED_WORKSPACES = True
+
     def __init__(self, task_args = []):
         assert os.geteuid() != 0, "Must not run the script with sudo - causes mm-delay issues"
         task_parser = argparse.ArgumentParser()
@@ -43,25 +48,42 @@ class CongestionControlBPF(EvolveInterface):
         task_parser.add_argument("--delay", type=int, default=20)
         task_parser.add_argument("--bdp_multiplier", type=int, default=2)
         task_parser.add_argument("--timeout", type=int, default=20)
+        task_parser.add_argument("--extra_traces", type=str, nargs="*", default=[], help="More Sage traces (file names in sage_traces/traces) to score every candidate on, together with wired<bw>")
+        task_parser.add_argument("--trace_agg", type=str, choices=["mean", "worst"], default="mean", help="How per-trace scores are combined: mean or worst case")
+        task_parser.add_argument("--eval_concurrency", type=int, default=4, help="Max number of traces emulated at once, each in its own mahimahi shell with its own iperf3 server")
+        task_parser.add_argument("--resident_kmod", action="store_true", default=False, help="Build and load the tcp_heuristic module once per run; candidates only swap the BPF program and map it uses")
         self.task_args = task_parser.parse_args(task_args)
 
         # trace
         self.trace_dir = os.path.join(os.getcwd(), "./tcp_cc/evaluate/sage_traces/traces/")
         self.trace_path = os.path.join(self.trace_dir, f"wired{self.task_args.bw}")
+        self.traces = [f"wired{self.task_args.bw}"] + self.task_args.extra_traces
+        for trace in self.traces:
+            assert os.path.exists(os.path.join(self.trace_dir, trace)), f"Trace {trace} not found in {self.trace_dir}"
 
-        # code
+        # code: every instance builds, pins and logs in a workspace of its own, so several
+        # evaluations on one host never overwrite each other's LLMCode.h or link logs
         self.code_dir = os.path.join(os.getcwd(), "./tcp_cc/bpf_scaffolding/")
-        self.build_dir = self.code_dir        
+        workspace_root = os.path.join(self.code_dir, "workspaces")
+        os.makedirs(workspace_root, exist_ok=True)
+        self.workspace_dir = tempfile.mkdtemp(prefix="ws_", dir=workspace_root)
+        atexit.register(shutil.rmtree, self.workspace_dir, True)
+        for name in SCAFFOLDING_FILES:
+            shutil.copy2(os.path.join(self.code_dir, name), self.workspace_dir)
+        self.build_dir = self.workspace_dir
         self.llm_code_path = os.path.join(self.build_dir, "LLMCode.h")
         self.utils_dir = os.path.join(os.getcwd(), "tcp_cc/utils")
 
         # logging
-        self.log_dir = os.path.join(os.getcwd(), "./tcp_cc/evaluate/logs/")
+        self.log_dir = os.path.join(self.workspace_dir, "logs")
 
         # run parameters
         self.task_args.bdp = (2 * self.task_args.bw * self.task_args.delay)/12.0
         self.task_args.qs = int(round(self.task_args.bdp * self.task_args.bdp_multiplier, 0))
 
+        # processes of the running evaluation; teardown only ever touches these
+        self.scope = None
+
     def run_info(self):
         return {
             "task_args": vars(self.task_args)
@@ -159,17 +181,27 @@ class CongestionControlBPF(EvolveInterface):
         ) + f'''### <stderr>: {stderr.strip()}'''
 
     def cleanup_build_env(self): 
-        os.system(f"ps aux | grep logi[c].py | tr -s ' ' | cut -d ' ' -f2 | xargs sudo kill -9")
-        os.system(f"cd {self.build_dir} && make clean > /dev/null 2>&1")
-        os.system(f"sudo pkill iperf3")
-        os.system(f"sudo pkill mm-link")
-        os.system(f"sudo pkill mm-delay")
+        if self.scope is not None:
+            # left over from an evaluation that did not finish
+            print(f"Tore down leftover evaluation processes in {self.scope.close():.2f}s")
+            self.scope = None
+        self.unpin_programs()
+        if not self.task_args.resident_kmod:
+            os.system(f"cd {self.build_dir} && make clean > /dev/null 2>&1")
         
         if os.path.exists(self.llm_code_path):
-            os.system(f"rm {self.llm_code_path} > /dev/null 2>&1")
+            os.remove(self.llm_code_path)
         else:
             print("LLM generated codefile does not exist")
     
+    def kmod_loaded(self) -> bool:
+        return os.path.exists("/sys/module/tcp_heuristic") and os.path.exists("/dev/cwnd_device")
+
+    def unpin_programs(self):
+        # build() compiles and pins the candidate's BPF program once, run_experiment attaches that pinned
+        # copy; pins are shared by candidates and workers, so this only removes stale and least recently used ones
+        os.system(f"cd {self.build_dir} && sudo python3 logic.py cleanup > /dev/null 2>&1")
+
     def copy_code(self, code: str):
         # add code to LLM code path
         with open(self.llm_code_path, "w") as f:
@@ -182,7 +214,8 @@ class CongestionControlBPF(EvolveInterface):
         self.cleanup_build_env()
         self.copy_code(code)
 
-        for i in range(3):
+        # the module does not contain candidate code; in resident mode it is only (re)built when it is not loaded
+        for i in range(0 if self.task_args.resident_kmod and self.kmod_loaded() else 3):
             try:
                 assert os.system(f"cd {self.build_dir} && make") == 0
                 break
@@ -191,78 +224,91 @@ class CongestionControlBPF(EvolveInterface):
                 os.system("sudo rmmod tcp_heuristic")
                 time.sleep(3)
         
-        proc = subprocess.Popen(
-            f"cd {self.build_dir} && sudo python3 logic.py test",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
+        scope = ProcessScope()
+        proc = scope.popen(f"cd {self.build_dir} && sudo python3 logic.py test")
 
         try:
             stdout, stderr = proc.communicate(timeout=60) # we wait 3 minutes at most for build
         except subprocess.TimeoutExpired:
-            assert os.name == "posix"
-            os.killpg(proc.pid, signal.SIGKILL)
-            stdout, stderr = proc.communicate()
+            stdout, stderr = scope.stop(proc, grace_seconds=0, sig=signal.SIGKILL)
+            scope.close()
             return False, stdout.strip(), stderr.strip()
+        scope.close()
         
         success = (proc.returncode == 0)
         return success, stdout.strip(), stderr.strip()
-    
-    def kill_process(self, proc):
-        proc.send_signal(signal.SIGINT)
 
-        for i in range(3):
-            try:
-                outputs = proc.communicate(timeout=5) 
-                return outputs
-            except subprocess.TimeoutExpired:
-                proc.kill()
-                os.killpg(proc.pid, signal.SIGKILL)
-        
-        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
-
-    def run_experiment(self):
-        bpf_probe_proc = subprocess.Popen(
-            f"cd {self.build_dir} && sudo python3 logic.py",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=os.setsid
-        )
-
-        iperf_server = subprocess.Popen(
-            f"pkill iperf3; iperf3 -s",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=os.setsid
-        )
-        log_location = os.path.join(self.log_dir, f"down")
-        sum_location = os.path.join(self.log_dir, f"sum")
-        os.system(f"rm -rfv {log_location} {sum_location}")
+    def run_trace(self, trace: str, port: int):
+        """
+        Emulates one trace: an iperf3 flow from a mahimahi shell (its own network namespace) to an
+        iperf3 server listening on port. Returns (success, results, logs).
+        """
+        iperf_server = self.scope.popen(f"iperf3 -s -p {port}")
+        trace_log_dir = os.path.join(self.log_dir, trace)
+        log_location = os.path.join(trace_log_dir, "down")
+        shutil.rmtree(trace_log_dir, ignore_errors=True)
+        os.makedirs(trace_log_dir)
 
-        cmd = f"mm-delay {self.task_args.delay} mm-link {self.trace_path} {os.path.join(self.trace_dir, 'wired192')} --uplink-queue-args=\"packets={self.task_args.qs}\"  --downlink-queue-args=\"packets={self.task_args.qs}\" --uplink-queue=droptail --downlink-queue=droptail --uplink-log={log_location} -- bash -c 'cd {self.utils_dir} && sudo LD_PRELOAD=./heuristic.so iperf3 -c $MAHIMAHI_BASE -t {self.task_args.timeout}'"
+        cmd = f"mm-delay {self.task_args.delay} mm-link {os.path.join(self.trace_dir, trace)} {os.path.join(self.trace_dir, 'wired192')} --uplink-queue-args=\"packets={self.task_args.qs}\"  --downlink-queue-args=\"packets={self.task_args.qs}\" --uplink-queue=droptail --downlink-queue=droptail --uplink-log={log_location} -- bash -c 'cd {self.utils_dir} && sudo LD_PRELOAD=./heuristic.so iperf3 -c $MAHIMAHI_BASE -p {port} -t {self.task_args.timeout}'"
         print(cmd)
 
-        measurement_proc = subprocess.Popen(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            preexec_fn=os.setsid
-        )
+        measurement_proc = self.scope.popen(cmd)
 
         try:
             measurement_proc.communicate(timeout=self.task_args.timeout + 5)
         except subprocess.TimeoutExpired:
-            output = self.kill_process(measurement_proc)
-        
+            self.scope.stop(measurement_proc)
+
+        logs = {"trace": trace, "iperf_logs": self.scope.stop(iperf_server)}
+
+        if not os.path.exists(log_location):
+            print(f"LOG MISSING for {trace}! :------(")
+            return False, {}, logs
+
+        try:
+            stats = read_link_log(log_location, ms_per_bin=500)
+        except AssertionError as e: # empty or truncated log
+            print(f"Unusable log for {trace}: {e}")
+            return False, {}, logs
+        results = {key: stats[key] for key in LINK_LOG_STATS}
+        print(results)
+        if results['queuing_delay_95p'] is None:
+            # no packet left the link
+            return False, results, logs
+        return True, results, logs
+
+    def combine_traces(self, trace_outputs):
+        """
+        Combines per-trace (success, results, logs) into one score: throughput / 95p queuing delay
+        per trace, aggregated with --trace_agg.
+        """
+        per_trace = []
+        for trace, (success, results, _) in zip(self.traces, trace_outputs):
+            if not success:
+                return False, {"results": results, "failed_trace": trace}
+            per_trace.append({
+                "trace": trace, "results": results,
+                "score": results['throughput'] / (1e-5 + results['queuing_delay_95p'])
+            })
+
+        scores = [entry["score"] for entry in per_trace]
+        final_results_dict = {
+            # per-metric means, so single-trace consumers of "results" keep working
+            "results": {key: sum(entry["results"][key] for entry in per_trace) / len(per_trace) for key in per_trace[0]["results"]},
+            "per_trace": per_trace,
+            "score": min(scores) if self.task_args.trace_agg == "worst" else sum(scores) / len(scores)
+        }
+        return True, final_results_dict
+
+    def run_experiment(self):
+        self.scope = ProcessScope()
+        bpf_probe_proc = self.scope.popen(f"cd {self.build_dir} && sudo python3 logic.py")
+
+        # every trace gets its own mahimahi shell and iperf3 port, so they can run side by side
+        ports = free_ports(len(self.traces))
+        with ThreadPoolExecutor(max_workers=max(1, min(self.task_args.eval_concurrency, len(self.traces)))) as pool:
+            trace_outputs = list(pool.map(self.run_trace, self.traces, ports))
+
         # get BPF probe stats
         bpftool_proc = subprocess.Popen(
             "sudo bpftool prog show",
@@ -274,39 +320,19 @@ class CongestionControlBPF(EvolveInterface):
         bpftool_stdout, bpftool_stderr = bpftool_proc.communicate(timeout=10)
 
 
-        # kill the BPF probe
-        os.system(f"ps aux | grep logi[c].py | tr -s ' ' | cut -d ' ' -f2 | xargs sudo kill -9")
+        # stop the BPF probe (SIGINT lets it unregister its map), then everything else this evaluation started
+        start = time.time()
+        bpf_output = self.scope.stop(bpf_probe_proc)
+        self.scope.close()
+        self.scope = None
+        teardown_seconds = time.time() - start
+        print(f"Teardown took {teardown_seconds:.2f}s")
 
-        bpf_output = self.kill_process(bpf_probe_proc)
-        iperf_output = self.kill_process(iperf_server)
-        
         eval_log_dict = {
             "bpf_logs": bpf_output,
-            "iperf_logs": iperf_output,
-            "bpftool_logs": bpftool_stdout
+            "per_trace": [logs for _, _, logs in trace_outputs],
+            "bpftool_logs": bpftool_stdout,
+            "teardown_seconds": teardown_seconds
         }
-
-        if os.path.exists(log_location):
-            mm_thr_proc = subprocess.Popen(
-                f"cd {self.log_dir} && mm-throughput-graph 500 down > /dev/null",
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                preexec_fn=os.setsid
-            )
-            
-            mm_thr_stdout, mm_thr_stderr = mm_thr_proc.communicate(timeout=5)
-            print(mm_thr_stderr)
-            final_results_dict = {
-                "results": parse_sum_file(mm_thr_stderr.splitlines())
-            }
-            
-            if 'queuing_delay_95p' in final_results_dict['results'].keys() and 'throughput' in final_results_dict['results'].keys():
-                final_results_dict['score'] = final_results_dict['results']['throughput'] / (1e-5 + final_results_dict['results']['queuing_delay_95p'])
-                return True, final_results_dict, eval_log_dict
-            else:
-                return False, final_results_dict, eval_log_dict
-        else:
-            print("LOG MISSING! :------(")
-            return False, {}, eval_log_dict
\ No newline at end of file
+        success, final_results_dict = self.combine_traces(trace_outputs)
+        return success, final_results_dict, eval_log_dict
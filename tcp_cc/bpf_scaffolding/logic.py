@@ -1,50 +1,189 @@
 from bcc import BPF
+from bcc.libbcc import lib
+import ctypes
 import fcntl
+import hashlib
+import os
+import platform
+import shutil
 import struct
+import subprocess
 import sys
 import time
 
 REGISTER_CWND = 0x0
 UNREGISTER_CWND = 0x1
+UNREGISTER_CWND_IF = 0x2
+
+# compiled programs are pinned here, under one directory per scaffolding (bpf_prog.h, tcp_heuristic.h
+# and the kernel) and one per program hash, so every workspace and worker on the host shares them
+PIN_ROOT = "/sys/fs/bpf/policysmith"
+# pins kept per scaffolding; least recently used ones beyond this are removed by cleanup
+MAX_PINS = 64
+PROG_PIN = "bpf_heuristic_logic_wrapper"
+MAP_PIN = "cwnd_map"
+KPROBE_EVENT = "tcp_heuristic:cong_control_logic"
+BPF_PROBE_ENTRY = 0
 
 def register_cwnd(fd_to_register, test_build=False):
     with open("/dev/cwnd_device", "r") as dev:
         packed_fd = struct.pack("i", fd_to_register)
         fcntl.ioctl(dev, REGISTER_CWND, packed_fd)
 
-def unregister_cwnd():
+def unregister_cwnd(fd_registered=None):
+    # with fd_registered, only unregisters if that map is still the registered one
     with open("/dev/cwnd_device", "r") as dev:
-        fcntl.ioctl(dev, UNREGISTER_CWND)
+        if fd_registered is None:
+            fcntl.ioctl(dev, UNREGISTER_CWND)
+        else:
+            fcntl.ioctl(dev, UNREGISTER_CWND_IF, struct.pack("i", fd_registered))
 
-def attach_cwnd_setter(test_build=False):
-    if test_build:
-        print("[logic.py] In TEST mode. Will exit immediately.")
-    
+def read_program():
     # get BPF program from files.
     with open("bpf_prog.h", 'r') as f:
         bpf_program = f.read()
     bpf_program += "\n\n\n"
     with open("LLMCode.h", 'r') as f:
         bpf_program += f.read()
+    return bpf_program
+
+def scaffolding_hash():
+    # everything a program is compiled from besides the candidate's code
+    with open("bpf_prog.h", 'r') as f:
+        prog = f.read()
+    with open("tcp_heuristic.h", 'r') as f:
+        header = f.read()
+    return hashlib.sha256("\0".join([prog, header, platform.release()]).encode()).hexdigest()[:16]
 
+def program_hash(bpf_program):
+    # the included header and the kernel the program is compiled against are part of the key
+    with open("tcp_heuristic.h", 'r') as f:
+        header = f.read()
+    return hashlib.sha256("\0".join([bpf_program, header, platform.release()]).encode()).hexdigest()[:16]
+
+def scaffolding_pin_root():
+    return os.path.join(PIN_ROOT, scaffolding_hash())
+
+def pin_dir(key):
+    return os.path.join(scaffolding_pin_root(), key)
+
+def ensure_bpffs():
+    if not os.path.ismount("/sys/fs/bpf"):
+        subprocess.run("mount -t bpf bpf /sys/fs/bpf", shell=True, check=True)
+    os.makedirs(scaffolding_pin_root(), exist_ok=True)
+
+def compile_and_pin(bpf_program, key):
+    """
+    Compiles the program with BCC and pins the kprobe program and cwnd_map under pin_dir(key).
+    """
     b = BPF(text=bpf_program)
-    fd = b["cwnd_map"].map_fd
-    register_cwnd(fd)
+    fn = b.load_func("bpf_heuristic_logic_wrapper", BPF.KPROBE)
+    tmp_dir = f"{pin_dir(key)}.{os.getpid()}"
+    os.makedirs(tmp_dir)
+    assert lib.bpf_obj_pin(fn.fd, os.path.join(tmp_dir, PROG_PIN).encode()) == 0, "Failed to pin program"
+    assert lib.bpf_obj_pin(b["cwnd_map"].map_fd, os.path.join(tmp_dir, MAP_PIN).encode()) == 0, "Failed to pin cwnd_map"
+    try:
+        os.rename(tmp_dir, pin_dir(key))
+    except OSError:
+        # another worker pinned the same program first
+        shutil.rmtree(tmp_dir)
+
+def load_program():
+    """
+    Returns (prog_fd, map_fd, key) of the current program, compiling it only if no pinned copy
+    with the same hash exists (or it was removed before we could open it).
+    """
+    ensure_bpffs()
+    bpf_program = read_program()
+    key = program_hash(bpf_program)
+    for attempt in range(2):
+        if os.path.isdir(pin_dir(key)):
+            print(f"[logic.py] Reusing pinned program {key}")
+        else:
+            start = time.time()
+            compile_and_pin(bpf_program, key)
+            print(f"[logic.py] Compiled and pinned program {key} in {time.time() - start:.2f}s")
+        prog_fd = lib.bpf_obj_get(os.path.join(pin_dir(key), PROG_PIN).encode())
+        map_fd = lib.bpf_obj_get(os.path.join(pin_dir(key), MAP_PIN).encode())
+        if prog_fd >= 0 and map_fd >= 0:
+            break
+        # evicted by another worker's cleanup in the meantime
+        for fd in (prog_fd, map_fd):
+            if fd >= 0:
+                os.close(fd)
+    assert prog_fd >= 0 and map_fd >= 0, "Failed to open pinned program -- why?"
+    try:
+        os.utime(pin_dir(key)) # mtime is the LRU clock of cleanup
+    except OSError:
+        pass
+    return prog_fd, map_fd, key
+
+def cleanup():
+    """
+    Removes pins compiled from a different scaffolding (stale after a change of bpf_prog.h,
+    tcp_heuristic.h or the kernel), and the least recently used pins beyond MAX_PINS. Pins of
+    other candidates stay, so a program seen before is never compiled again. Unpinned programs
+    are freed by the kernel once no process holds them anymore, and a worker whose pin is removed
+    before it opens it just compiles again (see load_program).
+    """
+    if not os.path.isdir(PIN_ROOT):
+        return
+    current = scaffolding_hash()
+    for scaffolding in os.listdir(PIN_ROOT):
+        if scaffolding != current:
+            shutil.rmtree(os.path.join(PIN_ROOT, scaffolding), ignore_errors=True)
+            print(f"[logic.py] Unpinned programs of stale scaffolding {scaffolding}")
+    root = scaffolding_pin_root()
+    if not os.path.isdir(root):
+        return
+    pins = []
+    for key in os.listdir(root):
+        try:
+            mtime = os.path.getmtime(os.path.join(root, key))
+        except OSError:
+            continue
+        if "." in key and time.time() - mtime < 600:
+            continue # being pinned by compile_and_pin right now
+        pins.append((mtime, key))
+    for _, key in sorted(pins, reverse=True)[MAX_PINS:]:
+        shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+        print(f"[logic.py] Unpinned {key}")
+
+def attach_cwnd_setter(test_build=False):
+    if test_build:
+        print("[logic.py] In TEST mode. Will exit immediately.")
+
+    prog_fd, fd, key = load_program()
 
     assert fd >= 0, "Failed to create fd -- why?"
 
-    # Attach kprobe to cong_control_logic
-    b.attach_kprobe(event="tcp_heuristic:cong_control_logic", fn_name="bpf_heuristic_logic_wrapper")
+    # Attach kprobe to cong_control_logic, then swap our map in: the module atomically switches
+    # from whatever map was registered before (e.g. a previous candidate's) to this one
+    ev_name = f"p_policysmith_{key}_{os.getpid()}".encode()
+    perf_fd = lib.bpf_attach_kprobe(prog_fd, BPF_PROBE_ENTRY, ev_name, KPROBE_EVENT.encode(), ctypes.c_uint64(0), 0)
+    assert perf_fd >= 0, f"Failed to attach to {KPROBE_EVENT}"
+    if test_build:
+        # verified, pinned and attachable; the evaluation attaches this very program. The map is
+        # not registered, so evaluations running on the host keep theirs.
+        os.close(perf_fd)
+        lib.bpf_detach_kprobe(ev_name)
+        print(f"[logic.py] Attached and detached {key}")
+        return
+    register_cwnd(fd)
     print("Attached to cong_control_logic. Press Ctrl+C to exit.")
-    
+
     try:
         while True:
             time.sleep(1)
-            if test_build:
-                break
     except KeyboardInterrupt:
-        unregister_cwnd()
+        unregister_cwnd(fd)
+        os.close(perf_fd)
+        lib.bpf_detach_kprobe(ev_name)
         print("\nExiting.")
 
 if __name__ == "__main__":
-    attach_cwnd_setter(test_build=(len(sys.argv) > 1 and sys.argv[1] == "test"))
\ No newline at end of file
+    # logic.py: attach the current program | logic.py test: compile, pin and test-attach it | logic.py cleanup: unpin stale programs
+    if len(sys.argv) > 1 and sys.argv[1] == "cleanup":
+        cleanup()
+    else:
+        attach_cwnd_setter(test_build=(len(sys.argv) > 1 and sys.argv[1] == "test"))
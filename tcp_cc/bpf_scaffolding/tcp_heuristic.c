@@ -168,7 +168,7 @@ static void heuristic_cong_control(struct sock *sk, const struct rate_sample *rs
 
 u32 noinline cong_control_logic(u8 ca_state, const struct heuristic_state *st, const struct rate_sample *rs, u32 prev_cwnd){
 	u32 new_cwnd;
-	if (lookup_cwnd(&new_cwnd)) {
+	if (lookup_cwnd(st, &new_cwnd)) {
 		pr_info("cong_control_logic: lookup success, new_cwnd = %u\n", new_cwnd);
 		return new_cwnd;
 	}
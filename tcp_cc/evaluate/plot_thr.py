@@ -5,6 +5,7 @@ Read the log file of mm-link and plot the throughput.
 import os
 import sys
 import matplotlib.pyplot as plt
+import numpy as np
 from utils import *
 
 if __name__ == "__main__":
@@ -34,29 +35,22 @@ if __name__ == "__main__":
         end_bin = ms_to_bins(end_time * 1000, ms_per_bin)
     # print(f"Plotting from bin {start_bin} to {end_bin}")
 
-    for index, log_file in enumerate(log_files):
+    for log_file in log_files:
         if not os.path.exists(log_file):
             print(f"Log file {log_file} does not exist.")
             sys.exit(1)
 
-        arrivals, departures, capacity, running_duration = read_down_file(
-            log_file, ms_per_bin
-        )
+    for index, stats in enumerate(read_link_logs(log_files, ms_per_bin)):
+        log_file = log_files[index]
+        running_duration = stats["running_duration"]
 
         # Plot the throughput
         time_bins = [i for i in range(ms_to_bins(running_duration, ms_per_bin))]
-        print(f"Total running duration: {running_duration} ms = {len(time_bins)} bins")
-
-        sending_rate = []
-        total_capacity = []
-        for bin in time_bins:
-            arrival = arrivals.get(bin, 0) / (10**3 * ms_per_bin)
-            departure = departures.get(bin, 0) / (10**3 * ms_per_bin)
-            unused_capacity = capacity.get(bin, 0) / (10**3 * ms_per_bin)
-            # print(f"Bin {bin}: {arrival} Mbps, {departure} Mbps, {unused_capacity} Mbps")
-
-            sending_rate.append(arrival)
-            total_capacity.append(unused_capacity)
+        print(f"Total running duration: {running_duration} ms = {len(time_bins)} bins, {stats['drops']} drops")
+
+        n_bins = len(time_bins)
+        sending_rate = list(np.pad(stats["arrivals"], (0, n_bins))[:n_bins] / (10**3 * ms_per_bin))
+        total_capacity = list(np.pad(stats["capacity_bins"], (0, n_bins))[:n_bins] / (10**3 * ms_per_bin))
 
         if end_time != -1:
             time_bins = [(x - start_bin) for x in time_bins[start_bin:end_bin]]
@@ -1,6 +1,9 @@
 """
 Util script for plotting functions
 """
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 def ms_to_bins(ms, ms_per_bin):
     return ms // ms_per_bin
@@ -26,57 +29,166 @@ def read_sum_file(filename):
     return utilization, delay_avg, delay_95p
 
 
-def read_down_file(filename, ms_per_bin):
-    base_time = None
-    running_duration = None
-    
-    # For plotting
-    arrivals = {}
-    departures = {}
-    capacity = {}
+# event codes of mm-link log lines: <timestamp> <event> <bytes> [<delay>]
+ARRIVAL, DEPARTURE, CAPACITY, DROP = ord('+'), ord('-'), ord('#'), ord('d')
+NOT_SENT = np.iinfo(np.int64).max
+SEPARATORS = np.array([ord(' '), ord('\t'), ord('\r'), ord('\n')], dtype=np.uint8)
+
+
+def parse_log_chunk(chunk):
+    """
+    Parses complete mm-link log lines (bytes) without a Python loop over lines.
+    Returns int64 arrays (timestamp, event, num_bytes, delay); delay is 0 except for departures.
+    """
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    is_sep = np.isin(buf, SEPARATORS)
+    # tokens are runs of non-separators
+    is_start = ~is_sep & np.concatenate(([True], is_sep[:-1]))
+    token_starts = np.flatnonzero(is_start)
+    token_ends = np.flatnonzero(~is_sep & np.concatenate((is_sep[1:], [True])))
+    if len(token_starts) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+
+    # value of each numeric token: sum of its digits times 10^(place from the token's end)
+    chars = np.flatnonzero(~is_sep)
+    char_tokens = np.cumsum(is_start[chars]) - 1
+    digits = buf[chars].astype(np.int64) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    place = token_ends[char_tokens] - chars
+    values = np.bincount(char_tokens, weights=np.where(is_digit, digits * 10 ** place, 0), minlength=len(token_starts)).astype(np.int64)
+    # non-numeric tokens (events) keep their first character
+    numeric = np.bincount(char_tokens, weights=~is_digit, minlength=len(token_starts)) == 0
+    values = np.where(numeric, values, buf[token_starts])
+
+    # group tokens into lines, skipping comment lines
+    line_of_token = np.cumsum(buf == ord('\n'))[token_starts]
+    first = np.flatnonzero(np.concatenate(([True], line_of_token[1:] != line_of_token[:-1])))
+    n_tokens = np.diff(np.concatenate((first, [len(token_starts)])))
+    data = (buf[token_starts[first]] != ord('#')) & (n_tokens >= 3)
+    first, n_tokens = first[data], n_tokens[data]
 
+    timestamp = values[first]
+    event = values[first + 1]
+    num_bytes = values[first + 2]
+    delay = np.where(n_tokens >= 4, values[np.minimum(first + 3, len(values) - 1)], 0)
+    return timestamp, event, num_bytes, delay
+
+
+def add_at(array, index, weights):
+    """
+    array += bincount(index, weights), growing array as needed. Returns the (possibly new) array.
+    """
+    counts = np.bincount(index, weights=weights) if len(index) else np.zeros(0)
+    if len(counts) > len(array):
+        array = np.concatenate((array, np.zeros(len(counts) - len(array), dtype=array.dtype)))
+    array[:len(counts)] += counts.astype(array.dtype)
+    return array
+
+
+def read_link_log(filename, ms_per_bin=500, chunk_bytes=1 << 24):
+    """
+    One pass over an mm-link log in chunks of chunk_bytes. Memory is bounded by the number of bins,
+    the largest delay and the log's duration (in ms), not by its number of packets. Returns the
+    per-bin arrivals, departures and unused capacity (bits), and the statistics mm-throughput-graph
+    reports: capacity and throughput (Mbits/s), utilization (%), per-packet queueing delay
+    (average, 50/95/99th percentile) and 95th percentile signal delay (ms), plus drops.
+    """
+    arrivals = np.zeros(0, dtype=np.int64)
+    departures = np.zeros(0, dtype=np.int64)
+    capacity = np.zeros(0, dtype=np.int64)
+    delay_hist = np.zeros(0, dtype=np.int64)
+    # minimum delay of the packets sent in each ms (its signal delay); NOT_SENT if none was
+    signal_delay = np.zeros(0, dtype=np.int64)
     drops = 0
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                if "base timestamp" in line:
-                    base_time = int(line.split()[-1])
+    base_time = None
+    first_time = None
+    last_time = None
+
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            chunk += f.readline() # finish the last line
+            if base_time is None:
+                for line in chunk.splitlines():
+                    if line.startswith(b"# base timestamp:"):
+                        base_time = int(line.split()[-1])
+                        break
+                assert base_time is not None, f"{filename} is missing its base timestamp"
+
+            timestamp, event, num_bytes, delay = parse_log_chunk(chunk)
+            timestamp = timestamp - base_time
+            keep = timestamp > 0 # like mm-throughput-graph, ignore events before the base timestamp
+            timestamp, event, num_bits, delay = timestamp[keep], event[keep], num_bytes[keep] * 8, delay[keep]
+            if len(timestamp) == 0:
                 continue
-            
-            # Validate if the line is of the form: <time> <event> <bytes>
-            tokens = line.strip().split()        
-
-            timestamp = int(tokens[0]) - base_time
-            ts_bin = ms_to_bins(timestamp, ms_per_bin)
-            running_duration = timestamp
-
-            event = tokens[1]
-            bytes = int(tokens[2])
-            num_bits = bytes * 8
-
-            if event == '-':
-                # Implies a successful packet delivery
-                if ts_bin not in departures:
-                    departures[ts_bin] = 0
-                departures[ts_bin] += num_bits
-            elif event == '+':
-                # Implies a packet arrival to the link
-                if ts_bin not in arrivals:
-                    arrivals[ts_bin] = 0
-                arrivals[ts_bin] += num_bits
-            elif event == '#':
-                # Implies an unused capacity
-                if ts_bin not in capacity:
-                    capacity[ts_bin] = 0
-                capacity[ts_bin] += num_bits
-            elif event == 'd':
-                # Implies a dropped packet
-                drops += 1
-            else:
-                print(f"Unknown event: {event}")
-
-    print_name = filename.split("/")[-1].split("-")[:4]
-    print(drops)
-    if drops > 10000:
-        print(f"{drops} drops in {print_name}")
-    return arrivals, departures, capacity, running_duration
\ No newline at end of file
+            if first_time is None:
+                first_time = int(timestamp[0])
+            last_time = max(int(timestamp.max()), last_time or 0)
+
+            bins = timestamp // ms_per_bin
+            arrived, departed, unused = event == ARRIVAL, event == DEPARTURE, event == CAPACITY
+            arrivals = add_at(arrivals, bins[arrived], num_bits[arrived])
+            departures = add_at(departures, bins[departed], num_bits[departed])
+            capacity = add_at(capacity, bins[unused], num_bits[unused])
+            drops += int(np.count_nonzero(event == DROP))
+
+            delay_hist = add_at(delay_hist, delay[departed], None)
+            sent = timestamp[departed] - delay[departed]
+            if len(sent):
+                if sent.max() >= len(signal_delay):
+                    signal_delay = np.concatenate((signal_delay, np.full(sent.max() + 1 - len(signal_delay), NOT_SENT, dtype=np.int64)))
+                np.minimum.at(signal_delay, sent, delay[departed])
+
+    assert first_time is not None, f"{filename} has no events"
+    stats = summarize_link_log(arrivals, departures, capacity, delay_hist, signal_delay, first_time, last_time)
+    stats.update({
+        "arrivals": arrivals, "departures": departures, "capacity_bins": capacity,
+        "drops": drops, "running_duration": last_time, "ms_per_bin": ms_per_bin
+    })
+    return stats
+
+
+def percentile_from_histogram(hist, q):
+    # the value at rank floor(q * n) of the sorted values, as mm-throughput-graph indexes them
+    cumulative = np.cumsum(hist)
+    rank = int(q * cumulative[-1])
+    return int(np.searchsorted(cumulative, rank, side='right'))
+
+
+def summarize_link_log(arrivals, departures, capacity, delay_hist, signal_delay, first_time, last_time):
+    duration = (last_time - first_time) / 1000.0
+    capacity_mbps = capacity.sum() / duration / 1e6
+    throughput = departures.sum() / duration / 1e6
+    stats = {
+        "capacity": float(capacity_mbps),
+        "ingress": float(arrivals.sum() / duration / 1e6),
+        "throughput": float(throughput),
+        "utilization": float(100.0 * throughput / capacity_mbps) if capacity_mbps > 0 else 0.0,
+        "queuing_delay_avg": None, "queuing_delay_50p": None, "queuing_delay_95p": None,
+        "queuing_delay_99p": None, "signal_delay_95p": None
+    }
+    if delay_hist.sum() == 0:
+        return stats
+    stats["queuing_delay_avg"] = float(np.dot(np.arange(len(delay_hist)), delay_hist) / delay_hist.sum())
+    for q in (50, 95, 99):
+        stats[f"queuing_delay_{q}p"] = percentile_from_histogram(delay_hist, q / 100)
+
+    # ms without a packet sent get the signal delay of the next ms + 1 (waiting for the next packet)
+    sent = np.flatnonzero(signal_delay != NOT_SENT)
+    span = signal_delay[sent[0]:sent[-1] + 1]
+    index = np.where(span != NOT_SENT, np.arange(len(span)), len(span))
+    next_sent = np.minimum.accumulate(index[::-1])[::-1]
+    filled = span[next_sent] + (next_sent - np.arange(len(span)))
+    stats["signal_delay_95p"] = percentile_from_histogram(np.bincount(filled), 0.95)
+    return stats
+
+
+def read_link_logs(filenames, ms_per_bin=500, workers=None):
+    """
+    read_link_log of several logs, in parallel processes.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(read_link_log, filenames, [ms_per_bin] * len(filenames)))
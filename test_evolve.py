@@ -1,6 +1,8 @@
 import argparse
+from llm_cache import ResponseCache
 from llm_wrappers import ALL_LLM_MODELS
 from EvolveRunner import EvolutionRunner
+from coordinator import LeaseWorker
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -10,8 +12,31 @@ if __name__ == "__main__":
     parser.add_argument("--start_iter_idx", type=int, default=0, help="Start iteration index")
     parser.add_argument("--end_iter_idx", type=int, default=1, help="End iteration index")
     parser.add_argument("--collection_id", type=str, default=None, help="if start_iter_idx > 0, this is the MongoDB collection ID to continue from")
+    parser.add_argument("--num_snippets", type=int, default=2, help="How many of the best programs so far are used as parents in the mutation prompt?")
+    parser.add_argument("--workers", type=int, default=1, help="Number of samples to generate, build and evaluate concurrently")
+    parser.add_argument("--llm_cache_dir", type=str, default=None, help="Directory of the on-disk LLM response cache (disabled if not set)")
+    parser.add_argument("--llm_cache_max_mb", type=float, default=None, help="Evict least recently used cached responses beyond this size")
+    parser.add_argument("--llm_replay", action="store_true", default=False, help="Serve every LLM response from --llm_cache_dir and fail on a miss")
+    parser.add_argument("--dedup", action="store_true", default=False, help="Reuse build/eval results of candidates identical (up to comments and whitespace) to ones seen before with the same task args")
+    parser.add_argument("--race", action="store_true", default=False, help="Build all samples of an iteration, then evaluate them together with successive halving (task must support run_experiment_group)")
+    parser.add_argument("--blob_store", type=str, default=None, help="Move large build/eval logs out of the heuristic documents: \"gridfs\" or a directory (kept inline if not set)")
+    parser.add_argument("--blob_threshold", type=int, default=4096, help="Logs longer than this (in characters) go to --blob_store")
+    parser.add_argument("--worker", action="store_true", default=False, help="Claim samples of --collection_id from the jobs seeded by coordinator.py, alongside other workers")
+    parser.add_argument("--lease_seconds", type=float, default=300, help="With --worker, a sample whose worker stops heartbeating for this long is handed to another worker")
     args, unknown_args = parser.parse_known_args()    
     assert args.model in ALL_LLM_MODELS.keys()
+    assert args.llm_cache_dir is not None or not args.llm_replay, "--llm_replay needs --llm_cache_dir"
 
-    evolver = EvolutionRunner(args.task, args.model, args.n_samples, args.start_iter_idx, args.end_iter_idx, args.collection_id, unknown_args)
+    llm_cache = None
+    if args.llm_cache_dir is not None:
+        max_bytes = int(args.llm_cache_max_mb * 1024 * 1024) if args.llm_cache_max_mb is not None else None
+        llm_cache = ResponseCache(args.llm_cache_dir, max_bytes=max_bytes, replay_only=args.llm_replay)
+
+    assert args.collection_id is not None or not args.worker, "--worker needs the --collection_id seeded by coordinator.py"
+
+    runner_kwargs = dict(n_workers=args.workers, num_snippets=args.num_snippets, llm_cache=llm_cache, dedup=args.dedup, race=args.race, blob_store=args.blob_store, blob_threshold=args.blob_threshold)
+    if args.worker:
+        evolver = LeaseWorker(args.task, args.model, args.n_samples, args.start_iter_idx, args.end_iter_idx, args.collection_id, unknown_args, lease_seconds=args.lease_seconds, **runner_kwargs)
+    else:
+        evolver = EvolutionRunner(args.task, args.model, args.n_samples, args.start_iter_idx, args.end_iter_idx, args.collection_id, unknown_args, **runner_kwargs)
     evolver.evolve()
\ No newline at end of file
@@ -0,0 +1,71 @@
+import argparse
+from pymongo import MongoClient
+
+from api_key import MONGO_CONNECTION_STRING
+
+def percentile(values, q):
+    # nearest-rank percentile; None for an empty phase
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+def summarize(name, values, unit="s"):
+    if len(values) == 0:
+        return f"{name:<28} n=0"
+    return (
+        f"{name:<28} n={len(values):<6} p50={percentile(values, 50):>9.2f}{unit} "
+        f"p95={percentile(values, 95):>9.2f}{unit} mean={sum(values) / len(values):>9.2f}{unit} total={sum(values):>10.1f}{unit}"
+    )
+
+def timing_report(collection, iters=None):
+    """
+    Summarizes the per-phase timings the runner stores on every heuristic document.
+    """
+    query = {"timings": {"$exists": True}}
+    if iters is not None:
+        query["iter"] = {"$gte": iters[0], "$lte": iters[1]}
+    docs = list(collection.find(query, {"timings": 1, "created_at": 1, "build_status": 1, "exec_status": 1, "iter": 1}))
+    if len(docs) == 0:
+        return "No documents with timings found."
+
+    llm_turns = [turn for doc in docs for turn in doc["timings"]["llm"]]
+    builds = [attempt for doc in docs for attempt in doc["timings"]["build"]]
+    evals = [doc["timings"]["eval"] for doc in docs if doc["timings"].get("eval") is not None]
+    totals = [doc["timings"]["total_seconds"] for doc in docs if doc["timings"].get("total_seconds") is not None]
+
+    created = [doc["created_at"] for doc in docs]
+    span_hours = (max(created) - min(created)).total_seconds() / 3600
+    if len(totals) > 0:
+        # the span runs from the first sample's start to roughly when the last one was written
+        last = max(docs, key=lambda doc: doc["created_at"])
+        span_hours += (last["timings"]["total_seconds"] or 0) / 3600
+
+    n_built = sum(1 for doc in docs if doc["build_status"])
+    lines = [
+        f"{len(docs)} samples over iters {min(d['iter'] for d in docs)}..{max(d['iter'] for d in docs)}",
+        f"samples/hour: {len(docs) / span_hours:.1f}" if span_hours > 0 else "samples/hour: n/a",
+        f"build success rate: {n_built / len(docs):.1%} of samples, {sum(1 for b in builds if b['success']) / max(1, len(builds)):.1%} of attempts "
+        f"({len(builds) / len(docs):.2f} attempts/sample)",
+        f"eval success rate: {sum(1 for doc in docs if doc['exec_status']) / max(1, n_built):.1%} of built samples",
+        "",
+        summarize("llm turn", [t["seconds"] for t in llm_turns if not t["cached"]]),
+        summarize("llm turn (cached)", [t["seconds"] for t in llm_turns if t["cached"]]),
+        summarize("llm per sample", [sum(t["seconds"] for t in doc["timings"]["llm"]) for doc in docs]),
+        summarize("prompt tokens per turn", [t["prompt_tokens"] for t in llm_turns if t["prompt_tokens"] is not None], unit=""),
+        summarize("gen tokens per turn", [t["gen_tokens"] for t in llm_turns if t["gen_tokens"] is not None], unit=""),
+        summarize("build attempt", [b["seconds"] for b in builds if not b["deduplicated"]]),
+        summarize("build per sample", [sum(b["seconds"] for b in doc["timings"]["build"]) for doc in docs]),
+        summarize("eval", [e["seconds"] for e in evals if not e.get("deduplicated", False)]),
+        summarize("sample total", totals),
+    ]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-phase timing summary (p50/p95, samples/hour, build success rate) of a run")
+    parser.add_argument("--collection_id", type=str, required=True, help="MongoDB collection of the run")
+    parser.add_argument("--iters", type=int, nargs=2, default=None, help="Only include iterations in this (inclusive) range")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGO_CONNECTION_STRING)
+    print(timing_report(client["policysmith"][args.collection_id], args.iters))
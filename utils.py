@@ -1,3 +1,4 @@
+import hashlib
 import re
 import subprocess
 
@@ -15,6 +16,35 @@ def cpp_comment_remover(text):
     )
     return re.sub(pattern, replacer, text)
 
+CPP_TOKEN_PATTERN = re.compile(
+    r'"(?:\\.|[^\\"])*"|\'(?:\\.|[^\\\'])*\'|[A-Za-z_]\w*|\d[\w.]*|'
+    r'<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||::|[-+*/%&|^!~=<>?:;,.(){}\[\]#]|\S'
+)
+
+def normalize_cpp(text):
+    """
+    Canonical form of a C/C++ snippet: comments removed and tokens joined by single spaces,
+    so code that only differs in comments, whitespace or line breaks normalizes identically.
+    Preprocessor directives end at their line break, so each one stays on a line of its own.
+    """
+    lines, code = [], []
+    # spliced lines (backslash-newline) are one line to the preprocessor as well
+    for line in cpp_comment_remover(text).replace("\\\n", " ").splitlines():
+        tokens = CPP_TOKEN_PATTERN.findall(line)
+        if tokens[:1] == ["#"]:
+            if code:
+                lines.append(" ".join(code))
+                code = []
+            lines.append(" ".join(tokens))
+        else:
+            code.extend(tokens)
+    if code:
+        lines.append(" ".join(code))
+    return "\n".join(lines)
+
+def code_hash(text, salt=""):
+    return hashlib.sha256((salt + "\n" + normalize_cpp(text)).encode()).hexdigest()
+
 def get_git_info(dir_path=None):
     git_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dir_path).decode().strip()
     status = subprocess.check_output(['git', 'status', '--porcelain'], cwd=dir_path).decode()
@@ -53,7 +53,7 @@ int main(int argc, char *argv[]) {
   // <trace_path> <size_type: percent/mb> <size> <collection_name> <mongo_id>
   const char *trace_path = argv[1];
   reader_t *reader = get_reader(trace_path);
-  TRACE_FOOTPRINT_BYTES = calculate_trace_footprint(reader);
+  TRACE_FOOTPRINT_BYTES = get_trace_metadata(reader).footprint_bytes;
 
   if(std::string(argv[2]) == "percent") {
     cache_percentage = std::stod(std::string(argv[3]));
@@ -0,0 +1,203 @@
+#include "simulate.h"
+
+#include <dlfcn.h>
+#include <signal.h>
+#include <sys/resource.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+
+/* Long-lived evaluation server: traces are opened (and their metadata loaded) once, and every
+ * request simulates a candidate heuristic built as a shared object (the PQEvolve translation unit
+ * linked with -shared -Wl,-Bsymbolic), resolving libCacheSim against this executable (-rdynamic).
+ *
+ * A request is one line on the Unix socket:
+ *   <plugin.so or -> <trace_path> <size_type: percent/mb> <size1> ... <sizeN> [run_multiple_sizes options]
+ *     [--time_limit=S] [--cpu_limit=S] [--mem_limit_mb=M]
+ * "-" simulates the PQEvolve heuristic built into the server (or --baseline). The reply is what
+ * run_multiple_sizes prints, followed by one {"eval_server_status": ...} line with the simulation's
+ * return code (negative signal number if it was killed) and stderr. */
+
+struct loaded_trace_t {
+  reader_t *reader;
+  long footprint_bytes;
+  long mapped_bytes; // size of the mmap'd file, 0 for traces read through a stream
+};
+
+std::map<std::string, loaded_trace_t> traces;
+
+loaded_trace_t &load_trace(const std::string &trace_path) {
+  if (traces.count(trace_path) == 0) {
+    reader_t *reader = get_reader(trace_path.c_str());
+    long mapped_bytes = 0;
+    struct stat st;
+    // libCacheSim mmaps uncompressed binary traces (see get_reader)
+    if (ends_with(trace_path.c_str(), ".oracleGeneral.bin") && stat(trace_path.c_str(), &st) == 0) mapped_bytes = st.st_size;
+    traces[trace_path] = {reader, get_trace_metadata(reader).footprint_bytes, mapped_bytes};
+  }
+  return traces[trace_path];
+}
+
+std::string json_escape(const std::string &s) {
+  std::string out;
+  for (char c : s) {
+    if (c == '"' || c == '\\') out += std::string("\\") + c;
+    else if (c == '\n') out += "\\n";
+    else if ((unsigned char)c < 0x20) {
+      char buf[8];
+      snprintf(buf, sizeof(buf), "\\u%04x", c);
+      out += buf;
+    } else out += c;
+  }
+  return out;
+}
+
+/* Runs in the simulation process: output goes to the client socket, and a crashing or runaway
+ * candidate only takes this process down. */
+void simulate_request(std::vector<std::string> args, std::map<std::string, std::string> &options, loaded_trace_t &trace) {
+  if (options.count("cpu_limit")) {
+    rlim_t seconds = (rlim_t)std::stod(options["cpu_limit"]);
+    struct rlimit limit = {seconds, seconds + 1};
+    setrlimit(RLIMIT_CPU, &limit);
+  }
+  if (options.count("mem_limit_mb")) {
+    // the simulation inherits the mappings of every trace the server has loaded; RLIMIT_AS counts
+    // them, but they are not part of the candidate's budget
+    rlim_t bytes = (rlim_t)(std::stod(options["mem_limit_mb"]) * MiB);
+    for (auto &loaded : traces) bytes += loaded.second.mapped_bytes;
+    struct rlimit limit = {bytes, bytes};
+    setrlimit(RLIMIT_AS, &limit);
+  }
+  if (options.count("time_limit")) alarm((unsigned)ceil(std::stod(options["time_limit"])));
+
+  cache_init_func_t cache_init = PQEvolve_init;
+  if (args[0] != "-") {
+    void *plugin = dlopen(args[0].c_str(), RTLD_NOW | RTLD_LOCAL);
+    if (plugin == nullptr) {
+      fprintf(stderr, "dlopen failed: %s\n", dlerror());
+      exit(1);
+    }
+    cache_init = (cache_init_func_t)dlsym(plugin, "PQEvolve_init");
+    if (cache_init == nullptr) {
+      fprintf(stderr, "PQEvolve_init not found in %s\n", args[0].c_str());
+      exit(1);
+    }
+    // -Bsymbolic binds the candidate's priority() timing to its own copy of the counters
+    uint64_t *calls = (uint64_t *)dlsym(plugin, "policysmith_priority_calls");
+    uint64_t *timed = (uint64_t *)dlsym(plugin, "policysmith_priority_timed_calls");
+    uint64_t *ns = (uint64_t *)dlsym(plugin, "policysmith_priority_ns");
+    uint64_t *sample_every = (uint64_t *)dlsym(plugin, "policysmith_priority_sample_every");
+    if (calls != nullptr && timed != nullptr && ns != nullptr && sample_every != nullptr) {
+      priority_calls_counter = calls;
+      priority_timed_counter = timed;
+      priority_ns_counter = ns;
+      priority_sample_every = sample_every;
+    }
+  }
+
+  TRACE_FOOTPRINT_BYTES = trace.footprint_bytes;
+  set_simulation_options(options);
+  std::vector<double> sizes;
+  for (size_t i = 3; i < args.size(); i++) sizes.push_back(std::stod(args[i]));
+  set_cache_sizes(args[2], sizes, options);
+
+  // forks share the file offset (and decompression state) of a stream reader, so concurrent
+  // requests on a compressed trace each read it through their own; mmap'd readers are private
+  reader_t *reader = trace.mapped_bytes > 0 ? trace.reader : get_reader(args[1].c_str());
+  run_one_cache_multiple_sizes(reader, cache_init);
+  fflush(stdout);
+  exit(0);
+}
+
+/* Runs in a per-request child of the server, so the accept loop never waits for a simulation. */
+void handle_request(int conn, const std::string &line) {
+  std::vector<std::string> tokens;
+  std::istringstream in(line);
+  for (std::string token; in >> token;) tokens.push_back(token);
+  std::vector<char *> argv;
+  for (auto &token : tokens) argv.push_back(&token[0]);
+  int argc = argv.size();
+  std::map<std::string, std::string> options = parse_options(&argc, argv.data());
+  std::vector<std::string> args(argv.begin(), argv.begin() + argc);
+
+  FILE *err = tmpfile();
+  int returncode;
+  if (args.size() < 4) {
+    fprintf(err, "Malformed request: %s\n", line.c_str());
+    returncode = 2;
+  } else if (access(args[1].c_str(), R_OK) != 0) {
+    fprintf(err, "Trace not found: %s\n", args[1].c_str());
+    returncode = 2;
+  } else {
+    loaded_trace_t &trace = load_trace(args[1]);
+    pid_t pid = fork();
+    if (pid == 0) {
+      dup2(conn, STDOUT_FILENO);
+      dup2(fileno(err), STDERR_FILENO);
+      simulate_request(args, options, trace);
+    }
+    int status;
+    waitpid(pid, &status, 0);
+    returncode = WIFSIGNALED(status) ? -WTERMSIG(status) : WEXITSTATUS(status);
+  }
+
+  std::string err_text;
+  rewind(err);
+  char buf[4096];
+  for (size_t n; (n = fread(buf, 1, sizeof(buf), err)) > 0;) err_text.append(buf, n);
+  fclose(err);
+  std::string status_line = "{\"eval_server_status\": {\"returncode\": " + std::to_string(returncode) +
+    ", \"stderr\": \"" + json_escape(err_text) + "\"}}\n";
+  if (write(conn, status_line.c_str(), status_line.size()) < 0) perror("write");
+}
+
+int main(int argc, char *argv[]) {
+  // <socket_path> [trace_path ...]: traces given here are loaded before the first request
+  assert(argc >= 2);
+  const char *socket_path = argv[1];
+  for (int i = 2; i < argc; i++) load_trace(argv[i]);
+
+  signal(SIGCHLD, SIG_IGN); // per-request children are reaped automatically
+  signal(SIGPIPE, SIG_IGN); // a client that went away must not kill the server
+
+  int server = socket(AF_UNIX, SOCK_STREAM, 0);
+  struct sockaddr_un addr;
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  assert(strlen(socket_path) < sizeof(addr.sun_path));
+  strcpy(addr.sun_path, socket_path);
+  unlink(socket_path);
+  if (bind(server, (struct sockaddr *)&addr, sizeof(addr)) != 0 || listen(server, 128) != 0) {
+    perror("eval_server");
+    return 1;
+  }
+  fprintf(stderr, "eval_server listening on %s\n", socket_path);
+
+  while (true) {
+    int conn = accept(server, nullptr, nullptr);
+    if (conn < 0) continue;
+
+    std::string line;
+    char c;
+    while (read(conn, &c, 1) == 1 && c != '\n') line += c;
+    if (line.empty()) { // e.g. a client checking that the server is up
+      close(conn);
+      continue;
+    }
+
+    // traces are loaded in the server itself, so later requests find them already open
+    std::istringstream in(line);
+    std::string plugin, trace_path;
+    if (in >> plugin >> trace_path && access(trace_path.c_str(), R_OK) == 0) load_trace(trace_path);
+
+    if (fork() == 0) {
+      close(server);
+      signal(SIGCHLD, SIG_DFL); // handle_request waits for its simulation
+      handle_request(conn, line);
+      close(conn);
+      _exit(0);
+    }
+    close(conn);
+  }
+}
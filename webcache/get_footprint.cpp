@@ -8,7 +8,8 @@ int main(int argc, char **argv) {
     size_t pos = trace_print_name.find(prefix_to_remove);
     if (pos != std::string::npos) trace_print_name.replace(pos, prefix_to_remove.size(), "");
 
-    printf("{\"trace\": \"%s\", \"footprint_mb\":%f}\n", trace_print_name.c_str(), calculate_trace_footprint(reader)/(1024.0 * 1024.0));
+    trace_metadata_t meta = get_trace_metadata(reader);
+    printf("{\"trace\": \"%s\", \"footprint_mb\":%f, \"n_obj\":%ld, \"n_req\":%ld}\n", trace_print_name.c_str(), meta.footprint_bytes/(1024.0 * 1024.0), meta.n_obj, meta.n_req);
     close_trace(reader);
     return 0;
 }
\ No newline at end of file
@@ -1,41 +1,168 @@
 import argparse
+import atexit
+import contextlib
+import fcntl
+import glob
+import hashlib
 import json
+import math
 import os
+import shlex
+import shutil
 import signal
+import socket
 import subprocess
+import tempfile
 import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 from Evolve import EvolveInterface
-from utils import cpp_comment_remover
+from proc_utils import WALL_TIME_LIMIT, classify_failure, run_limited
+from utils import cpp_comment_remover, get_git_info
+from webcache.trace_cache import TraceCache
+from webcache.trace_metadata import ensure_trace_metadata
+
+# placeholder heuristic compiled into the shared base build; candidates replace it per workspace
+DEFAULT_LLM_CODE = textwrap.dedent('''\
+    int priority(
+      uint64_t current_time, obj_id_t obj_id, pq_cache_obj_info& obj_info,
+      CountsInfo<int32_t>& counts, AgeInfo<int64_t> ages, SizeInfo<int64_t>& sizes,
+      History& history
+    ){
+      return obj_info.last_access_vtime; // LRU
+    }
+''')
+
+# stands in for LLMCode.h when extracting the declarations a priority() plugin is compiled against
+ABI_MARKER = "POLICYSMITH_ABI_MARKER"
 
 class WebCacheEvolve(EvolveInterface):
+    ISOLATED_WORKSPACES = True
+    SUPPORTS_GROUP_EVAL = True
+
+    # exact LRU results per (trace, sizes) that sampled runs are checked against; shared by all instances
+    exact_lru = {}
+    exact_lru_lock = threading.Lock()
+    # per eval server socket: this process's shared flock on <socket>.users, held while it may send requests
+    eval_server_users = {}
+
     def __init__(self, web_args = []):
         task_parser = argparse.ArgumentParser()
         task_parser.add_argument("--trace", type=str, default="CloudPhysics/w106.oracleGeneral.bin.zst")
-        task_parser.add_argument("--cache_sizes", type=float, nargs=1, default=[128], help="List of cache sizes to test")
-        task_parser.add_argument("--eval_cache_size", type=float, default=128, help="Final cache size (objective)")
+        task_parser.add_argument("--extra_traces", type=str, nargs="*", default=[], help="More traces to score every candidate on, together with --trace")
+        task_parser.add_argument("--trace_agg", type=str, choices=["mean", "worst"], default="mean", help="How per-trace scores are combined: mean or worst-case hit rate")
+        task_parser.add_argument("--race_fractions", type=float, nargs="+", default=[0.05, 0.25], help="Racing mode: trace prefixes (fractions of requests), or sample rates with --race_mode sample, of the rounds before the full run")
+        task_parser.add_argument("--race_mode", type=str, choices=["prefix", "sample"], default="prefix", help="Racing mode: whether race_fractions are trace prefixes or --sample_rate values of the screening rounds")
+        task_parser.add_argument("--sample_rate", type=float, default=None, help="Simulate only objects hash-sampled at this rate, with cache sizes scaled to match (SHARDS); approximate but faster fitness")
+        task_parser.add_argument("--race_keep", type=float, default=0.5, help="Racing mode: fraction of candidates promoted to the next round")
+        task_parser.add_argument("--trace_cache_dir", type=str, default=None, help="Where decompressed (mmap-able) copies of the traces are kept (default: webcache/trace_cache)")
+        task_parser.add_argument("--trace_cache_max_gb", type=float, default=None, help="Disk quota of the trace cache; least recently used traces are evicted beyond it")
+        task_parser.add_argument("--no_trace_cache", action="store_true", help="Simulate the compressed traces directly")
+        task_parser.add_argument("--time_limit", type=float, default=None, help="Wall-clock limit (seconds) of one trace simulation")
+        task_parser.add_argument("--cpu_limit", type=float, default=None, help="CPU-time limit (seconds) of one trace simulation")
+        task_parser.add_argument("--mem_limit_mb", type=float, default=None, help="Address-space / memory limit (MB) of one trace simulation")
+        task_parser.add_argument("--build_mode", type=str, choices=["inline", "plugin"], default="inline", help="inline: compile each candidate into PQEvolve and relink the simulator (fastest simulation); plugin: compile only priority() into a shared object loaded by a prebuilt simulator (fastest build)")
+        task_parser.add_argument("--eval_server", type=str, default=None, help="Unix socket of a long-lived eval_server.o (started if nothing listens there); candidates are built as shared objects and simulated by it")
+        task_parser.add_argument("--priority_budget_ns", type=float, default=None, help="CPU budget of priority() per request (ns); slower candidates get their score reduced")
+        task_parser.add_argument("--time_every", type=int, default=None, help="Time 1 in N requests and priority() calls and report the estimated costs (default: 64 with --priority_budget_ns, otherwise no timing)")
+        task_parser.add_argument("--runtime_penalty", type=float, default=0.1, help="Score reduction per 100%% that priority() exceeds --priority_budget_ns")
+        task_parser.add_argument("--eval_cores", type=int, default=None, help="Max number of trace simulations run in parallel (default: number of CPUs)")
+        task_parser.add_argument("--cache_sizes", type=float, nargs="+", default=[128], help="List of cache sizes to test (all simulated in one pass over the trace)")
+        task_parser.add_argument("--sweep", type=int, default=None, help="Instead of --cache_sizes itself, test this many geometrically spaced sizes between its two values")
+        task_parser.add_argument("--eval_cache_size", type=float, default=128, help="Final cache size (objective of --score eval_size)")
+        task_parser.add_argument("--score", type=str, choices=["eval_size", "auc"], default="eval_size", help="Score a candidate by its hit rate at --eval_cache_size, or by the (weighted) area under its hit-rate curve over all cache sizes")
+        task_parser.add_argument("--auc_weights", type=float, nargs="+", default=None, help="--score auc: weight of each cache size (default: trapezoidal area over log cache size)")
         task_parser.add_argument('--percent', action='store_true', default=False, help='Using --percent means that cache_sizes and eval_cache_sizes are treated as a percentage (b/w 0 and 100)')
         task_parser.add_argument('--byte', action='store_true', default=True, help='Use byte miss ratio instead of request miss ratio')
         self.task_args = task_parser.parse_args(web_args)
 
-        assert self.task_args.eval_cache_size in self.task_args.cache_sizes, f"Eval cache size {self.task_args.eval_cache_size} must be in cache sizes {self.task_args.cache_sizes}"
-        assert len(set(self.task_args.cache_sizes)) == len(self.task_args.cache_sizes)
+        self.cache_sizes = self.task_args.cache_sizes
+        if self.task_args.sweep is not None:
+            assert len(self.cache_sizes) == 2 and self.task_args.sweep >= 2, "--sweep needs --cache_sizes <min> <max>"
+            lo, hi = sorted(self.cache_sizes)
+            self.cache_sizes = [float(f"{lo * (hi / lo) ** (i / (self.task_args.sweep - 1)):.6g}") for i in range(self.task_args.sweep)]
+        if self.task_args.score == "eval_size":
+            assert self.task_args.eval_cache_size in self.cache_sizes, f"Eval cache size {self.task_args.eval_cache_size} must be in cache sizes {self.cache_sizes}"
+        else:
+            assert len(self.cache_sizes) >= 2 or self.task_args.auc_weights is not None, "--score auc needs at least two cache sizes"
+            assert self.task_args.auc_weights is None or len(self.task_args.auc_weights) == len(self.cache_sizes), "--auc_weights needs one weight per cache size"
+        assert len(set(self.cache_sizes)) == len(self.cache_sizes)
+        assert self.task_args.sample_rate is None or 0 < self.task_args.sample_rate <= 1, "--sample_rate must be in (0, 1]"
         assert self.task_args.percent or self.task_args.byte
+        assert self.task_args.build_mode == "inline" or self.task_args.eval_server is None, "--eval_server loads whole PQEvolve builds; use --build_mode inline"
         
         self.code_dir = os.path.join(os.getcwd(), "webcache")
         self.build_dir = os.path.join(self.code_dir, "build")
-        os.makedirs(self.build_dir, exist_ok=True)
+        self.pqevolve_dir = os.path.join(self.code_dir, "libCacheSim/libCacheSim/cache/eviction/PQEvolve")
+        self.llm_code_path = os.path.join(self.pqevolve_dir, "LLMCode.h")
+        self.plugin_dir = os.path.join(self.build_dir, "plugin")
+        self.plugin_runner = os.path.join(self.plugin_dir, "run_multiple_sizes.o")
+        self.abi_header = os.path.join(self.plugin_dir, "pqevolve_abi.h")
 
-        self.llm_code_path = os.path.join(self.code_dir, "./libCacheSim/libCacheSim/cache/eviction/PQEvolve/LLMCode.h")
+        self.eval_cores = self.task_args.eval_cores or os.cpu_count()
 
         self.trace_dir = "../libCacheSim/data/"
         self.trace_path = os.path.join(self.trace_dir, self.task_args.trace)
-        assert os.path.exists(os.path.join(self.build_dir, self.trace_path)), f"{os.path.join(self.build_dir, self.trace_path)} not found."
+
+        # libCacheSim and the harness are built once (shared by all instances); every instance
+        # then only recompiles the PQEvolve translation unit and relinks inside its own workspace
+        self.ensure_base_build()
+        if self.task_args.build_mode == "plugin":
+            unavailable = os.path.join(self.plugin_dir, "unavailable")
+            assert not os.path.exists(unavailable), f"Plugin builds are unavailable (see {unavailable}); use --build_mode inline"
+
+        self.traces = []
+        for trace in [self.task_args.trace] + self.task_args.extra_traces:
+            trace_path = os.path.join(self.trace_dir, trace)
+            assert os.path.exists(os.path.join(self.build_dir, trace_path)), f"{os.path.join(self.build_dir, trace_path)} not found."
+            trace_metadata = ensure_trace_metadata(
+                os.path.normpath(os.path.join(self.build_dir, trace_path)),
+                os.path.join(self.build_dir, "get_footprint.o")
+            )
+            if not self.task_args.percent:
+                footprint_mb = trace_metadata["footprint_bytes"] / (1024 * 1024)
+                assert max(self.cache_sizes) < footprint_mb, f"Cache sizes {self.cache_sizes} MB must be smaller than the footprint of {trace} ({footprint_mb:.1f} MB)"
+            self.traces.append({"name": trace, "path": trace_path, "metadata": trace_metadata})
+        assert len(set(t["name"] for t in self.traces)) == len(self.traces), "Duplicate traces"
+        self.trace_metadata = self.traces[0]["metadata"]
+
+        # per-call timing costs clock reads, so it is only on when asked for or needed for the penalty
+        self.time_every = self.task_args.time_every if self.task_args.time_every is not None else (64 if self.task_args.priority_budget_ns is not None else 0)
+
+        self.trace_cache = None
+        if not self.task_args.no_trace_cache:
+            self.trace_cache = TraceCache(
+                self.task_args.trace_cache_dir or os.path.join(self.code_dir, "trace_cache"),
+                int(self.task_args.trace_cache_max_gb * 1024 ** 3) if self.task_args.trace_cache_max_gb is not None else None
+            )
+
+        workspace_root = os.path.join(self.code_dir, "workspaces")
+        os.makedirs(workspace_root, exist_ok=True)
+        self.workspace_dir = tempfile.mkdtemp(prefix="ws_", dir=workspace_root)
+        atexit.register(shutil.rmtree, self.workspace_dir, True)
+        self.workspace_pqevolve_dir = os.path.join(self.workspace_dir, "PQEvolve")
+        if self.task_args.build_mode == "plugin":
+            self.binary_path = os.path.join(self.workspace_dir, "priority.so")
+        elif self.task_args.eval_server is not None:
+            self.binary_path = os.path.join(self.workspace_dir, "candidate.so")
+        else:
+            self.binary_path = os.path.join(self.workspace_dir, "run_multiple_sizes.o")
+        self.snapshot_dir = tempfile.mkdtemp(prefix="snapshots_", dir=workspace_root)
+        atexit.register(shutil.rmtree, self.snapshot_dir, True)
+        self.n_snapshots = 0
+
+        if self.task_args.eval_server is not None:
+            self.ensure_eval_server()
     
     def run_info(self):
         return {
-            "task_args": vars(self.task_args)
+            "task_args": vars(self.task_args),
+            "trace_metadata": {
+                t["name"]: {k: v for k, v in t["metadata"].items() if k != "size_histogram_log2"} for t in self.traces
+            }
         }
 
     def common_prompt(self) -> str:
@@ -65,6 +192,9 @@ class WebCacheEvolve(EvolveInterface):
             * `history`: stores recently evicted objects. Use `history.contains(obj_id)` to check if `curr` was recently evicted and readded to cache. Additionally, if `obj_id` is in `history`, `auto info = history.get_metadata(obj_id)` fetches information on the object - specifically `info->count` (count of how many times it was accessed before eviction) and `info->age_at_eviction_time` (how long - in time - was the object present in cache before it's previous eviction).
 
             You do not have to define function prototypes or include any headers - just write the implementation of `priority()`. You can choose to use all of these features or a subset of them'''
+        ) + (
+            f" `priority()` runs on every access, so keep it cheap: candidates spending more than {self.task_args.priority_budget_ns:g} ns per call are penalized (`.percentile()` queries are the most expensive inputs)."
+            if self.task_args.priority_budget_ns is not None else ""
         )
     
     def initial_prompt(self) -> str:
@@ -106,19 +236,219 @@ class WebCacheEvolve(EvolveInterface):
         # strip stdout and stderr to the first 2000 chars
         return textwrap.dedent(f'''\
             Your code unfortunately errored out. Read the build stderr logs (given below), think about what the error messages might mean, and then provide a complete, corrected version of the code in a formatted code block like you did earlier. Line numbers you see in the stderr logs do not correspond to line numbers in your code block; the build system is complex and it copies your code into the correct place amongst a bunch of other code, so it will be off by an offset.\n'''
-        ) + f'''### <stderr>: {stderr.strip()}'''
+        ) + f'''### <stderr>: {self.strip_workspace_paths(stderr).strip()}'''
+
+    def strip_workspace_paths(self, text: str) -> str:
+        # workspace names are random; keep them out of prompts so cached LLM replies can be replayed
+        return text.replace(self.workspace_dir + os.sep, "")
+
+    def base_build_stamp(self) -> str:
+        """
+        Hash of everything the shared base build depends on (libCacheSim revision, harness sources and
+        the default LLMCode.h it is built with).
+        """
+        h = hashlib.sha256(json.dumps(get_git_info(os.path.join(self.code_dir, "libCacheSim"))).encode())
+        h.update(DEFAULT_LLM_CODE.encode())
+        for path in sorted(glob.glob(os.path.join(self.code_dir, "*.cpp")) + glob.glob(os.path.join(self.code_dir, "*.h"))) + [os.path.join(self.code_dir, "CMakeLists.txt")]:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def ensure_base_build(self):
+        """
+        Builds libCacheSim and the harness objects once and caches them in self.build_dir. The lock
+        makes concurrent instances (and processes) wait for a single build instead of racing.
+        """
+        stamp_path = os.path.join(self.build_dir, ".base_build_stamp")
+        with open(os.path.join(self.code_dir, ".base_build.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # the base always contains the default priority(), never a candidate's LLMCode.h left in the
+            # submodule; it is written before the stamp, which covers the submodule's git status
+            with open(self.llm_code_path, "w") as f:
+                f.write(DEFAULT_LLM_CODE)
+            stamp = self.base_build_stamp()
+            if os.path.exists(stamp_path) and open(stamp_path).read() == stamp:
+                self.load_base_build()
+                return
+
+            print(f"Building libCacheSim base in {self.build_dir}")
+            os.system(f"rm -rf {self.build_dir} > /dev/null 2>&1")
+            os.makedirs(self.build_dir)
+            assert os.system(f"cd {self.build_dir} && cmake -DCMAKE_EXPORT_COMPILE_COMMANDS=ON ../ > /dev/null 2>&1") == 0
+            assert os.system(f"cd {self.build_dir} && make -j") == 0, "Base build of libCacheSim failed"
+
+            self.load_base_build()
+            # the per-candidate link uses a copy of the library without PQEvolve's objects
+            if self.base_archive is not None:
+                shutil.copyfile(self.base_archive, self.stripped_archive)
+                members = " ".join(os.path.basename(unit["output"]) for unit in self.pqevolve_units)
+                assert os.system(f"ar d {self.stripped_archive} {members}") == 0
+            self.build_plugin_base()
+
+            with open(stamp_path, "w") as f:
+                f.write(stamp)
+
+    def load_base_build(self):
+        """
+        Reads the PQEvolve compile commands and the run_multiple_sizes link command from the base build.
+        """
+        with open(os.path.join(self.build_dir, "compile_commands.json")) as f:
+            compile_commands = json.load(f)
+
+        pqevolve_dir = os.path.realpath(self.pqevolve_dir) + os.sep
+        self.pqevolve_units = []
+        for entry in compile_commands:
+            source = os.path.realpath(os.path.join(entry["directory"], entry["file"]))
+            if not source.startswith(pqevolve_dir):
+                continue
+            args = entry["arguments"] if "arguments" in entry else shlex.split(entry["command"])
+            self.pqevolve_units.append({
+                "directory": entry["directory"],
+                "args": args,
+                "source": source,
+                "output": entry.get("output", args[args.index("-o") + 1]),
+            })
+        assert len(self.pqevolve_units) > 0, "No PQEvolve sources found in compile_commands.json"
+
+        with open(os.path.join(self.build_dir, "CMakeFiles/run_multiple_sizes.o.dir/link.txt")) as f:
+            self.link_args = shlex.split(f.read())
+        archives = [arg for arg in self.link_args if arg.endswith(".a") and "libCacheSim" in os.path.basename(arg)]
+        self.base_archive_arg = archives[0] if archives else None
+        self.base_archive = os.path.join(self.build_dir, archives[0]) if archives else None
+        self.stripped_archive = os.path.join(self.build_dir, "libCacheSim_without_PQEvolve.a")
+
+        # plugins are compiled with the PQEvolve flags, minus what names the input and output files
+        unit = self.pqevolve_units[0]
+        self.plugin_compiler = unit["args"][0]
+        self.plugin_flags = []
+        skip = False
+        for arg in unit["args"][1:]:
+            if skip:
+                skip = False
+            elif arg in ["-o", "-MF", "-MT", "-MQ"]:
+                skip = True
+            elif arg not in ["-c", "-MD", "-MMD"] and os.path.realpath(os.path.join(unit["directory"], arg)) != unit["source"]:
+                self.plugin_flags.append(arg)
+        self.plugin_flags += [f"-I{self.pqevolve_dir}", "-fPIC"]
+
+    def build_plugin_base(self):
+        """
+        Prepares --build_mode plugin: pqevolve_abi.h (everything the PQEvolve translation unit declares
+        before including LLMCode.h) with its precompiled header, and a run_multiple_sizes.o whose PQEvolve
+        forwards priority() to a plugin (priority_plugin.h). A failure only disables plugin builds.
+        """
+        os.makedirs(self.plugin_dir, exist_ok=True)
+        unit = self.pqevolve_units[0]
+        source_of = lambda pqevolve_copy: os.path.join(pqevolve_copy, os.path.relpath(unit["source"], os.path.realpath(self.pqevolve_dir)))
+
+        marker_dir = os.path.join(self.plugin_dir, "abi", "PQEvolve")
+        shutil.copytree(self.pqevolve_dir, marker_dir, dirs_exist_ok=True)
+        with open(os.path.join(marker_dir, "LLMCode.h"), "w") as f:
+            f.write(ABI_MARKER + "\n")
+        dispatch_dir = os.path.join(self.plugin_dir, "PQEvolve")
+        shutil.copytree(self.pqevolve_dir, dispatch_dir, dirs_exist_ok=True)
+        with open(os.path.join(dispatch_dir, "LLMCode.h"), "w") as f:
+            f.write(f'#include "{os.path.join(self.code_dir, "priority_plugin.h")}"\n')
+        test_source = os.path.join(self.plugin_dir, "test_priority.cpp")
+        self.write_plugin_source(test_source, DEFAULT_LLM_CODE)
+
+        steps = [
+            f"cd {shlex.quote(unit['directory'])} && {shlex.join([self.plugin_compiler] + self.plugin_flags + ['-E', '-P', '-dD', source_of(marker_dir), '-o', os.path.join(self.plugin_dir, 'abi.ii')])}",
+            self.write_abi_header,
+            f"cd {shlex.quote(unit['directory'])} && {shlex.join([self.plugin_compiler] + self.plugin_flags + ['-x', 'c++-header', self.abi_header, '-o', self.abi_header + '.gch'])}",
+            self.plugin_build_command(test_source, os.path.join(self.plugin_dir, "test_priority.so")),
+            self.build_commands(dispatch_dir, self.plugin_dir, self.plugin_runner, shared=False, extra_link_args=["-ldl"]),
+        ]
+        for step in steps:
+            if callable(step):
+                ok, stderr = step()
+            else:
+                proc = subprocess.run(step, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                ok, stderr = proc.returncode == 0, proc.stderr
+            if not ok:
+                print(f"Plugin builds unavailable: {stderr.strip()[-2000:]}")
+                with open(os.path.join(self.plugin_dir, "unavailable"), "w") as f:
+                    f.write(f"{step if isinstance(step, str) else step.__name__}\n{stderr}")
+                return
+
+    def write_abi_header(self):
+        with open(os.path.join(self.plugin_dir, "abi.ii")) as f:
+            preprocessed = f.read()
+        if ABI_MARKER not in preprocessed:
+            return False, f"{ABI_MARKER} not found in the preprocessed PQEvolve source"
+        # -dD keeps the include guards, so candidates can still #include system headers; the
+        # compiler's own predefined __STDC* macros must not be redefined though
+        prelude = preprocessed.split(ABI_MARKER)[0].splitlines(keepends=True)
+        with open(self.abi_header, "w") as f:
+            f.write("".join(line for line in prelude if not line.startswith("#define __STDC")))
+        return True, ""
+
+    def write_plugin_source(self, path, code):
+        with open(path, "w") as f:
+            f.write(code)
+            f.write(f'\n#define POLICYSMITH_PLUGIN_ENTRY\n#include "{os.path.join(self.code_dir, "priority_plugin.h")}"\n')
+
+    def plugin_build_command(self, source, output) -> str:
+        # one compiler invocation; the ABI header comes precompiled (pqevolve_abi.h.gch)
+        return f"cd {shlex.quote(self.pqevolve_units[0]['directory'])} && " + shlex.join([self.plugin_compiler] + self.plugin_flags + ["-shared", "-include", self.abi_header, source, "-o", output])
+
+    def build_commands(self, pqevolve_copy_dir=None, obj_dir=None, binary_path=None, shared=None, extra_link_args=[]) -> str:
+        """
+        Shell command that compiles the workspace copy of PQEvolve and links run_multiple_sizes against it
+        (or, with --eval_server, into a shared object the server loads). With --build_mode plugin, it only
+        compiles the candidate's priority() into a shared object.
+        """
+        if pqevolve_copy_dir is None and self.task_args.build_mode == "plugin":
+            source = os.path.join(self.workspace_dir, "priority.cpp")
+            return self.plugin_build_command(source, self.binary_path)
+        pqevolve_copy_dir = pqevolve_copy_dir or self.workspace_pqevolve_dir
+        obj_dir = obj_dir or self.workspace_dir
+        binary_path = binary_path or self.binary_path
+        shared = self.task_args.eval_server is not None if shared is None else shared
+
+        commands = []
+        objects = []
+        for unit in self.pqevolve_units:
+            source = os.path.join(pqevolve_copy_dir, os.path.relpath(unit["source"], os.path.realpath(self.pqevolve_dir)))
+            obj = os.path.join(obj_dir, os.path.basename(unit["output"]))
+            args = list(unit["args"])
+            args[args.index("-o") + 1] = obj
+            args = [source if os.path.realpath(os.path.join(unit["directory"], arg)) == unit["source"] else arg for arg in args]
+            # sibling includes (e.g. "../../include/...") still resolve against the original source tree
+            args.append(f"-I{self.pqevolve_dir}")
+            if shared:
+                args.append("-fPIC")
+            commands.append(f"cd {shlex.quote(unit['directory'])} && {shlex.join(args)}")
+            objects.append(obj)
+
+        if shared:
+            # -Bsymbolic keeps the candidate's PQEvolve symbols from binding to the copy inside the server
+            commands.append(f"{shlex.quote(self.link_args[0])} -shared -Wl,-Bsymbolic -o {shlex.quote(binary_path)} {shlex.join(objects)}")
+            return " && ".join(commands)
+
+        link_args = list(self.link_args)
+        link_args[link_args.index("-o") + 1] = binary_path
+        if self.base_archive is not None:
+            link_args[link_args.index(self.base_archive_arg)] = self.stripped_archive
+        link_args[link_args.index("-o"):link_args.index("-o")] = objects
+        commands.append(f"cd {shlex.quote(self.build_dir)} && {shlex.join(link_args + extra_link_args)}")
+        return " && ".join(commands)
 
     def cleanup_build_env(self): 
-        os.system(f"rm -rfv {self.build_dir} > /dev/null 2>&1") 
-        if os.path.exists(self.llm_code_path):
-            os.system(f"rm {self.llm_code_path} > /dev/null 2>&1")
-        else:
-            print("llmcode.h not exists")
+        os.system(f"rm -rf {self.workspace_dir}/* > /dev/null 2>&1")
     
     def copy_code(self, code: str):
-        # add code to LLM code path
-        with open(self.llm_code_path, "w") as f:
+        if self.task_args.build_mode == "plugin":
+            self.write_plugin_source(os.path.join(self.workspace_dir, "priority.cpp"), code)
+            return
+        # every workspace gets a private copy of PQEvolve with the candidate's LLMCode.h, wrapped so
+        # that PQEvolve calls a timed priority() which forwards to the candidate's (priority_timing.h)
+        shutil.copytree(self.pqevolve_dir, self.workspace_pqevolve_dir, dirs_exist_ok=True)
+        timing_header = os.path.join(self.code_dir, "priority_timing.h")
+        with open(os.path.join(self.workspace_pqevolve_dir, "LLMCode.h"), "w") as f:
+            f.write(f'#include "{timing_header}"\n#define priority(...) policysmith_llm_priority(__VA_ARGS__)\n#line 1 "LLMCode.h"\n')
             f.write(code)
+            f.write(f'\n#undef priority\n#define POLICYSMITH_TIMED_PRIORITY\n#include "{timing_header}"\n')
 
     def build(self, code: str) -> Tuple[bool, str, str]:
         """
@@ -126,16 +456,14 @@ class WebCacheEvolve(EvolveInterface):
         """
         self.cleanup_build_env()
         self.copy_code(code)
-        
-        os.mkdir(self.build_dir)
-        assert os.system(f"cd {self.build_dir} && cmake ../ > /dev/null 2>&1") == 0
 
         proc = subprocess.Popen(
-            f"cd {self.build_dir} && make -j",
+            self.build_commands(),
             shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            start_new_session=True
         )
         
 
@@ -150,61 +478,315 @@ class WebCacheEvolve(EvolveInterface):
         success = (proc.returncode == 0)
         return success, stdout.strip(), stderr.strip()
     
-    def run_experiment(self):
-        proc = subprocess.Popen(
-            f"cd {self.build_dir} && ./run_multiple_sizes.o {self.trace_path} {'percent' if self.task_args.percent else 'mb'} {' '.join(map(str, self.task_args.cache_sizes))}",
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+    def run_trace(self, binary_path, trace, max_req=None, sample_rate=None, baseline=None):
+        """
+        Simulates one trace (or only its first max_req requests, or only the objects sampled at
+        sample_rate). Returns (success, results_list, logs)
+        """
+        options = []
+        if max_req is not None:
+            options.append(f"--max_req={max_req} --checkpoint_every={max(1, max_req // 10)}")
+        if sample_rate is not None and sample_rate < 1.0:
+            options.append(f"--sample_rate={sample_rate}")
+        if baseline is not None:
+            options.append(f"--baseline={baseline}")
+        if self.time_every > 0:
+            options.append(f"--time_every={self.time_every}")
+        trace_path = os.path.normpath(os.path.join(self.build_dir, trace["path"]))
+        with self.trace_cache.use(trace_path) if self.trace_cache is not None else contextlib.nullcontext(trace_path) as trace_path:
+            # libCacheSim mmaps decompressed traces; that mapping is not part of the candidate's budget
+            mapped_bytes = os.path.getsize(trace_path) if trace_path.endswith(".oracleGeneral.bin") else 0
+            args = f"{trace_path} {'percent' if self.task_args.percent else 'mb'} {' '.join(map(str, self.cache_sizes))} {' '.join(options)}"
+            if self.task_args.eval_server is not None:
+                # the server simulates its built-in PQEvolve ("-") for baselines, and the candidate otherwise
+                returncode, stdout, stderr, failure_reason = self.run_on_server(binary_path if binary_path.endswith(".so") else "-", args)
+            else:
+                if binary_path.endswith(".so"):
+                    # a priority() plugin, run by the prebuilt simulator
+                    binary_path = f"POLICYSMITH_PRIORITY_PLUGIN={shlex.quote(binary_path)} {self.plugin_runner}"
+                returncode, stdout, stderr, failure_reason = run_limited(
+                    f"cd {self.build_dir} && {binary_path} {args}",
+                    wall_seconds=self.task_args.time_limit,
+                    cpu_seconds=self.task_args.cpu_limit,
+                    mem_bytes=int(self.task_args.mem_limit_mb * 1024 * 1024) if self.task_args.mem_limit_mb is not None else None,
+                    mapped_bytes=mapped_bytes
+                )
+        logs = {"trace": trace["name"], "returncode": returncode, "stdout": stdout, "stderr": stderr, "failure_reason": failure_reason}
+        if failure_reason is not None:
+            return False, [], logs
+
+        lines = list(
+            map(
+                lambda x: json.loads(x),
+                list(filter(lambda x: x.startswith("{"), stdout.splitlines()))
+            )
         )
-        try:
-            stdout, stderr = proc.communicate()
-        except subprocess.TimeoutExpired:
-            assert os.name == "posix"
-            os.killpg(proc.pid, signal.SIGKILL)
-            stdout, stderr = proc.communicate()
-            eval_logs_tmp = {
-                "returncode": proc.returncode,
-                "stdout": stdout,
-                "stderr": stderr
-            }
-            return False, {}, eval_logs_tmp
+        results_list = [line for line in lines if "checkpoint" not in line]
+        checkpoints = [line for line in lines if "checkpoint" in line]
+        # the harness reports sizes in the order they were passed
+        assert len(results_list) == len(self.cache_sizes), f"Expected {len(self.cache_sizes)} results, got {len(results_list)}"
+        for size, result in zip(self.cache_sizes, results_list):
+            result["cache_size"] = size
+        if len(checkpoints) > 0:
+            for result in results_list:
+                result["checkpoints"] = [c for c in checkpoints if c["cache_size_bytes"] == result["cache_size_bytes"]]
+        if max_req is None and any("sample_rate" in result for result in results_list):
+            self.add_sampling_error(trace, results_list)
+        return True, results_list, logs
 
-        success = (proc.returncode == 0)
+    def eval_server_alive(self) -> bool:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.task_args.eval_server) # the server ignores connections without a request
+                return True
+            except OSError:
+                return False
 
-        eval_logs = {
-            "returncode": proc.returncode,
-            "stdout": stdout,
-            "stderr": stderr
-        }
-        
-        if success:
-            stdout = stdout.splitlines()
-            results_list = list(
-                map(
-                    lambda x: json.loads(x),
-                    list(filter(lambda x: x.startswith("{"), stdout))
+    def ensure_eval_server(self):
+        """
+        Starts eval_server.o on --eval_server unless one already listens there. The lock makes concurrent
+        instances (and processes) share a single server. Every process using it holds a shared lock on
+        <socket>.users until it exits, so the server outlives all but its last user (see release_eval_server).
+        """
+        path = self.task_args.eval_server
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if path not in WebCacheEvolve.eval_server_users:
+                users = open(path + ".users", "a")
+                fcntl.flock(users, fcntl.LOCK_SH)
+                WebCacheEvolve.eval_server_users[path] = users
+                atexit.register(WebCacheEvolve.release_eval_server, path)
+            if self.eval_server_alive():
+                return
+            print(f"Starting eval server on {path}")
+            with open(path + ".log", "a") as log:
+                proc = subprocess.Popen(
+                    [os.path.join(self.build_dir, "eval_server.o"), path],
+                    stdout=log, stderr=log, start_new_session=True
                 )
-            )
+            with open(path + ".pid", "w") as f:
+                f.write(str(proc.pid))
+            deadline = time.time() + 60
+            while not self.eval_server_alive():
+                assert proc.poll() is None, f"eval_server.o exited, see {path}.log"
+                assert time.time() < deadline, f"eval_server.o is not listening on {path}"
+                time.sleep(0.1)
 
-            if self.task_args.percent:
-                assert len(results_list) == len(self.task_args.cache_sizes), f"How?"
-                relevant_index = sorted(self.task_args.cache_sizes).index(self.task_args.eval_cache_size)
-                relevant_result = sorted(results_list, key=lambda x: x['cache_size_mb'])[relevant_index]
-            else:
-                relevant_result = list(filter(lambda x: x['cache_size_mb'] == self.task_args.eval_cache_size, results_list))
-                assert len(relevant_result) == 1
-                relevant_result = relevant_result[0]
+    @staticmethod
+    def release_eval_server(path):
+        """
+        Drops this process's use of the eval server. The last user stops the server if one of them
+        started it (a server started by hand has no <socket>.pid and keeps running).
+        """
+        with open(path + ".lock", "w") as lock:
+            # nobody starts using the server while we check whether we were the last user
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            users = WebCacheEvolve.eval_server_users.pop(path)
+            with users:
+                fcntl.flock(users, fcntl.LOCK_UN)
+                try:
+                    fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return # other processes still use it
+            try:
+                with open(path + ".pid") as f:
+                    pid = int(f.read())
+                os.remove(path + ".pid")
+                with open(f"/proc/{pid}/cmdline", "rb") as f:
+                    if b"eval_server.o" not in f.read():
+                        return # the server is gone and its pid was reused
+                print(f"Stopping eval server on {path}")
+                os.kill(pid, signal.SIGTERM)
+            except (OSError, ValueError):
+                pass
 
-            # Determine the relevant column based on the task argument
-            relevant_column = "byte_miss_ratio" if self.task_args.byte else "miss_ratio"
-            
-            # final score is average hit rate
-            final_result_dict = {
-                "score": 1 - relevant_result[relevant_column],
-                "results": results_list
+    def run_on_server(self, plugin, args):
+        """
+        Sends one simulation request to the eval server. Returns (returncode, stdout, stderr, failure_reason)
+        like run_limited; the limits are enforced by the server in the simulating process.
+        """
+        limits = {"time_limit": self.task_args.time_limit, "cpu_limit": self.task_args.cpu_limit, "mem_limit_mb": self.task_args.mem_limit_mb}
+        request = f"{plugin} {args} " + " ".join(f"--{k}={v}" for k, v in limits.items() if v is not None) + "\n"
+        chunks = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            # the server kills the simulation at time_limit; this only guards against a hung server
+            sock.settimeout(self.task_args.time_limit + 60 if self.task_args.time_limit is not None else None)
+            try:
+                sock.connect(self.task_args.eval_server)
+                sock.sendall(request.encode())
+                chunk = sock.recv(1 << 16)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = sock.recv(1 << 16)
+            except socket.timeout:
+                return -signal.SIGKILL, b"".join(chunks).decode(errors="replace"), "eval server timed out", WALL_TIME_LIMIT
+
+        lines = b"".join(chunks).decode(errors="replace").splitlines()
+        if len(lines) == 0 or not lines[-1].startswith('{"eval_server_status"'):
+            return -1, "\n".join(lines), "eval server closed the connection without a status", classify_failure(-1, "")
+        status = json.loads(lines[-1])["eval_server_status"]
+        failure_reason = classify_failure(
+            status["returncode"], status["stderr"],
+            wall_seconds=self.task_args.time_limit, cpu_seconds=self.task_args.cpu_limit,
+            mem_bytes=int(self.task_args.mem_limit_mb * 1024 * 1024) if self.task_args.mem_limit_mb is not None else None
+        )
+        return status["returncode"], "\n".join(lines[:-1]), status["stderr"], failure_reason
+
+    def exact_lru_results(self, trace):
+        """
+        Full-trace LRU results of the base build, computed once per trace and cache sizes.
+        """
+        key = (trace["path"], self.task_args.percent, tuple(self.cache_sizes))
+        with WebCacheEvolve.exact_lru_lock:
+            if key not in WebCacheEvolve.exact_lru:
+                success, results_list, logs = self.run_trace(os.path.join(self.build_dir, "run_multiple_sizes.o"), trace, baseline="LRU")
+                assert success, f"Exact LRU baseline failed on {trace['name']}: {logs['stderr']}"
+                WebCacheEvolve.exact_lru[key] = {r["cache_size_bytes"]: r for r in results_list}
+            return WebCacheEvolve.exact_lru[key]
+
+    def add_sampling_error(self, trace, results_list):
+        # the harness runs LRU on the same sample; its deviation from exact LRU estimates the sampling error
+        exact = self.exact_lru_results(trace)
+        for result in results_list:
+            lru = exact[result["cache_size_bytes"]]
+            result["sampling_error"] = {
+                "miss_ratio": abs(result["lru_sampled_miss_ratio"] - lru["miss_ratio"]),
+                "byte_miss_ratio": abs(result["lru_sampled_byte_miss_ratio"] - lru["byte_miss_ratio"])
             }
-            return success, final_result_dict, eval_logs
-        else:
-            return success, {}, eval_logs
+
+    def miss_ratio_curve(self, results_list):
+        return [
+            {k: r[k] for k in ["cache_size", "cache_size_bytes", "miss_ratio", "byte_miss_ratio"]}
+            for r in sorted(results_list, key=lambda r: r["cache_size_bytes"])
+        ]
+
+    def score_results(self, results_list) -> float:
+        # score on a single trace is the hit rate
+        relevant_column = "byte_miss_ratio" if self.task_args.byte else "miss_ratio"
+        if self.task_args.score == "eval_size":
+            relevant_result = list(filter(lambda x: x['cache_size'] == self.task_args.eval_cache_size, results_list))
+            assert len(relevant_result) == 1
+            return 1 - relevant_result[0][relevant_column]
+
+        # area under the hit-rate curve, normalized to [0, 1]
+        if self.task_args.auc_weights is not None:
+            weights = dict(zip(self.cache_sizes, self.task_args.auc_weights))
+            return sum(weights[r["cache_size"]] * (1 - r[relevant_column]) for r in results_list) / sum(weights.values())
+        curve = sorted(results_list, key=lambda r: r["cache_size_bytes"])
+        xs = [math.log(r["cache_size_bytes"]) for r in curve]
+        hits = [1 - r[relevant_column] for r in curve]
+        area = sum((xs[i + 1] - xs[i]) * (hits[i] + hits[i + 1]) / 2 for i in range(len(curve) - 1))
+        return area / (xs[-1] - xs[0])
+
+    def run_jobs(self, jobs):
+        """
+        Runs (binary_path, trace, max_req, sample_rate) simulations, at most eval_cores at a time. The largest
+        jobs are started first so the wall-clock time is bounded by the largest trace, not the sum of all of them.
+        """
+        job_size = lambda job: (job[2] if job[2] is not None else job[1]["metadata"]["n_req"]) * (job[3] or 1.0)
+        order = sorted(range(len(jobs)), key=lambda i: job_size(jobs[i]), reverse=True)
+        with ThreadPoolExecutor(max_workers=max(1, min(self.eval_cores, len(jobs)))) as pool:
+            futures = {i: pool.submit(self.run_trace, *jobs[i]) for i in order}
+            return [futures[i].result() for i in range(len(jobs))]
+
+    def combine_traces(self, trace_outputs):
+        """
+        Combines per-trace (success, results_list, logs) into run_experiment's return value.
+        """
+        eval_logs = {"per_trace": [logs for _, _, logs in trace_outputs]}
+        if not all(success for success, _, _ in trace_outputs):
+            eval_logs["failure_reason"] = [logs["failure_reason"] for success, _, logs in trace_outputs if not success][0]
+            return False, {}, eval_logs
+
+        per_trace = []
+        for trace, (_, results_list, _) in zip(self.traces, trace_outputs):
+            per_trace.append({
+                "trace": trace["name"], "score": self.score_results(results_list), "results": results_list,
+                "mrc": self.miss_ratio_curve(results_list), "runtime": self.runtime_metrics(results_list)
+            })
+            penalty = self.runtime_penalty(per_trace[-1]["runtime"])
+            if penalty > 0:
+                per_trace[-1]["unpenalized_score"] = per_trace[-1]["score"]
+                per_trace[-1]["runtime_penalty"] = penalty
+                per_trace[-1]["score"] -= penalty
+
+        scores = [t["score"] for t in per_trace]
+        final_result_dict = {
+            "score": min(scores) if self.task_args.trace_agg == "worst" else sum(scores) / len(scores),
+            "results": per_trace[0]["results"], # results on --trace, kept for plot_progress.ipynb
+            "mrc": per_trace[0]["mrc"],
+            "per_trace": per_trace,
+            "priority_ns_per_request": max((t["runtime"]["priority_ns_per_request"] for t in per_trace if t["runtime"]["priority_ns_per_request"] is not None), default=None)
+        }
+        errors = [r["sampling_error"] for t in per_trace for r in t["results"] if "sampling_error" in r]
+        if len(errors) > 0:
+            final_result_dict["sampling_error"] = max(e["byte_miss_ratio" if self.task_args.byte else "miss_ratio"] for e in errors)
+        return True, final_result_dict, eval_logs
+
+    def runtime_metrics(self, results_list):
+        # the harness reports run-level timings on every size's line
+        keys = ["runtime_seconds", "trace_read_seconds", "simulate_seconds", "priority_seconds", "priority_calls", "priority_ns_per_call", "priority_ns_per_request"]
+        return {k: results_list[0].get(k) for k in keys}
+
+    def runtime_penalty(self, runtime) -> float:
+        """
+        Score reduction for a priority() slower than --priority_budget_ns per request: runtime_penalty
+        for every 100% over the budget.
+        """
+        if self.task_args.priority_budget_ns is None or runtime["priority_ns_per_request"] is None:
+            return 0.0
+        excess = runtime["priority_ns_per_request"] / self.task_args.priority_budget_ns - 1
+        return self.task_args.runtime_penalty * max(0.0, excess)
+
+    def run_experiment(self):
+        return self.combine_traces(self.run_jobs([(self.binary_path, trace, None, self.task_args.sample_rate) for trace in self.traces]))
+
+    def snapshot(self):
+        """
+        Copy of the last successful build that stays valid after later calls to build()
+        """
+        self.n_snapshots += 1
+        handle = os.path.join(self.snapshot_dir, f"{self.n_snapshots}_{os.path.basename(self.binary_path)}")
+        shutil.copy2(self.binary_path, handle)
+        return handle
+
+    def run_experiment_group(self, handles):
+        """
+        Successive halving: every candidate runs on a prefix of each trace (or, with --race_mode sample,
+        on a spatially sampled subset of its objects), and only the best race_keep fraction moves on to
+        the next (longer / denser) round, ending with a full run. Candidates that drop out keep the
+        results of the last round they ran, marked as partial.
+        """
+        outputs = [None] * len(handles)
+        alive = list(range(len(handles)))
+        fractions = sorted(f for f in self.task_args.race_fractions if f < 1.0) + [1.0]
+        for round_idx, fraction in enumerate(fractions):
+            jobs = []
+            for c in alive:
+                for trace in self.traces:
+                    if fraction >= 1.0:
+                        jobs.append((handles[c], trace, None, self.task_args.sample_rate))
+                    elif self.task_args.race_mode == "sample":
+                        jobs.append((handles[c], trace, None, fraction))
+                    else:
+                        jobs.append((handles[c], trace, max(1, int(trace["metadata"]["n_req"] * fraction)), self.task_args.sample_rate))
+            trace_outputs = self.run_jobs(jobs)
+
+            n_traces = len(self.traces)
+            for k, c in enumerate(alive):
+                success, results, logs = self.combine_traces(trace_outputs[k * n_traces:(k + 1) * n_traces])
+                results["race"] = {"round": round_idx, "fraction": fraction}
+                results["partial"] = fraction < 1.0
+                outputs[c] = (success, results, logs)
+
+            if fraction >= 1.0:
+                break
+            ranked = sorted([c for c in alive if outputs[c][0]], key=lambda c: outputs[c][1]["score"], reverse=True)
+            alive = ranked[:max(1, math.ceil(len(ranked) * self.task_args.race_keep))]
+            print(f"[race] round {round_idx} ({self.task_args.race_mode}={fraction}): {len(alive)}/{len(ranked)} candidates promoted")
+            if len(alive) == 0:
+                break
+
+        for handle in handles:
+            os.remove(handle)
+        return outputs
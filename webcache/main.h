@@ -1,25 +1,163 @@
 #include "libCacheSim/libCacheSim/include/libCacheSim.h"
 
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include <cmath>
+#include <fstream>
+#include <map>
+#include <sstream>
 #include <thread>
 #include <string>
 #include <unordered_set>
+#include <vector>
+
+/* Per-trace metadata, computed once and stored next to the trace as <trace>.meta.json.
+ * The sidecar is only trusted if the trace's size and mtime still match. */
+const long TRACE_METADATA_VERSION = 1;
+const int SIZE_HISTOGRAM_BUCKETS = 48;
+
+struct trace_metadata_t {
+  long footprint_bytes = 0;
+  long n_obj = 0;
+  long n_req = 0;
+  long size_histogram[SIZE_HISTOGRAM_BUCKETS] = {0}; // unique objects by floor(log2(obj_size))
+};
+
+std::string trace_metadata_path(const char *trace_path) {
+  return std::string(trace_path) + ".meta.json";
+}
+
+bool read_trace_metadata(const char *trace_path, trace_metadata_t *meta) {
+  struct stat st;
+  if (stat(trace_path, &st) != 0) return false;
+  std::ifstream in(trace_metadata_path(trace_path));
+  if (!in) return false;
+  std::stringstream buf;
+  buf << in.rdbuf();
+  std::string s = buf.str();
+
+  auto field = [&](const char *key, long *out) {
+    std::string pattern = std::string("\"") + key + "\":";
+    size_t pos = s.find(pattern);
+    if (pos == std::string::npos) return false;
+    *out = strtol(s.c_str() + pos + pattern.size(), nullptr, 10);
+    return true;
+  };
+
+  long version, trace_size, trace_mtime;
+  if (!field("version", &version) || version != TRACE_METADATA_VERSION) return false;
+  if (!field("trace_size_bytes", &trace_size) || trace_size != (long)st.st_size) return false;
+  if (!field("trace_mtime", &trace_mtime) || trace_mtime != (long)st.st_mtime) return false;
+  if (!field("footprint_bytes", &meta->footprint_bytes) || !field("n_obj", &meta->n_obj) ||
+      !field("n_req", &meta->n_req)) return false;
+
+  std::string pattern = "\"size_histogram_log2\":[";
+  size_t pos = s.find(pattern);
+  if (pos == std::string::npos) return false;
+  const char *p = s.c_str() + pos + pattern.size();
+  for (int i = 0; i < SIZE_HISTOGRAM_BUCKETS; i++) {
+    char *end;
+    meta->size_histogram[i] = strtol(p, &end, 10);
+    if (end == p) return false;
+    p = (*end == ',') ? end + 1 : end;
+  }
+  return true;
+}
+
+void write_trace_metadata(const char *trace_path, const trace_metadata_t &meta) {
+  struct stat st;
+  if (stat(trace_path, &st) != 0) return;
+  std::string path = trace_metadata_path(trace_path);
+  std::string tmp_path = path + ".tmp." + std::to_string(getpid());
+  FILE *f = fopen(tmp_path.c_str(), "w");
+  if (f == nullptr) {
+    fprintf(stderr, "Could not write trace metadata to %s\n", path.c_str());
+    return;
+  }
+  fprintf(f,
+    "{\"version\":%ld,\"trace_size_bytes\":%ld,\"trace_mtime\":%ld,"
+    "\"footprint_bytes\":%ld,\"n_obj\":%ld,\"n_req\":%ld,\"size_histogram_log2\":[",
+    TRACE_METADATA_VERSION, (long)st.st_size, (long)st.st_mtime,
+    meta.footprint_bytes, meta.n_obj, meta.n_req);
+  for (int i = 0; i < SIZE_HISTOGRAM_BUCKETS; i++)
+    fprintf(f, "%s%ld", i == 0 ? "" : ",", meta.size_histogram[i]);
+  fprintf(f, "]}\n");
+  fclose(f);
+  rename(tmp_path.c_str(), path.c_str()); // atomic, so concurrent harnesses never see a partial file
+}
+
+trace_metadata_t compute_trace_metadata(reader_t *reader) {
+  reset_reader(reader);
+  trace_metadata_t meta;
+  request_t req;
+  std::unordered_set<uint64_t> unique_objects;
 
-long calculate_trace_footprint(reader_t *reader) {
-    reset_reader(reader);
-    long footprint = 0;
-    request_t req;
-    std::unordered_set<uint64_t> unique_objects;
-
-    while (read_trace(reader, &req) == 0) {
-        if(unique_objects.find(req.obj_id) == unique_objects.end()) {
-          unique_objects.insert(req.obj_id);
-          footprint += req.obj_size;
-          assert(req.obj_size > 0);
-        }
+  while (read_trace(reader, &req) == 0) {
+    meta.n_req++;
+    if(unique_objects.find(req.obj_id) == unique_objects.end()) {
+      unique_objects.insert(req.obj_id);
+      meta.footprint_bytes += req.obj_size;
+      assert(req.obj_size > 0);
+      int bucket = 63 - __builtin_clzll((unsigned long long)req.obj_size);
+      meta.size_histogram[std::min(bucket, SIZE_HISTOGRAM_BUCKETS - 1)]++;
     }
-    reset_reader(reader); // Reset the reader to the beginning
-    fprintf(stderr, "Trace footprint: %.3f MB\n", footprint/(1024.0 * 1024.0));
-    return footprint;
+  }
+  meta.n_obj = unique_objects.size();
+  reset_reader(reader); // Reset the reader to the beginning
+  return meta;
+}
+
+trace_metadata_t get_trace_metadata(reader_t *reader) {
+  trace_metadata_t meta;
+  if (read_trace_metadata(reader->trace_path, &meta)) {
+    fprintf(stderr, "Trace metadata read from %s\n", trace_metadata_path(reader->trace_path).c_str());
+  } else {
+    meta = compute_trace_metadata(reader);
+    write_trace_metadata(reader->trace_path, meta);
+  }
+  fprintf(stderr, "Trace footprint: %.3f MB\n", meta.footprint_bytes/(1024.0 * 1024.0));
+  return meta;
+}
+
+/* Pulls "--key=value" (or bare "--flag") options out of argv and compacts the remaining
+ * positional arguments in place, updating argc. */
+std::map<std::string, std::string> parse_options(int *argc, char **argv) {
+  std::map<std::string, std::string> options;
+  int n_positional = 0;
+  for (int i = 0; i < *argc; i++) {
+    std::string arg(argv[i]);
+    if (i > 0 && arg.rfind("--", 0) == 0) {
+      size_t eq = arg.find('=');
+      if (eq == std::string::npos) options[arg.substr(2)] = "1";
+      else options[arg.substr(2, eq - 2)] = arg.substr(eq + 1);
+    } else {
+      argv[n_positional++] = argv[i];
+    }
+  }
+  *argc = n_positional;
+  return options;
+}
+
+/* SHARDS-style spatial sampling: an object is sampled iff its hashed id falls below
+ * sample_rate * SAMPLE_MODULUS, so either all or none of an object's requests are simulated. */
+const uint64_t SAMPLE_MODULUS = 1ULL << 24;
+
+uint64_t sample_threshold(double sample_rate) {
+  return (uint64_t)(sample_rate * SAMPLE_MODULUS);
+}
+
+bool sample_object(uint64_t obj_id, uint64_t threshold) {
+  // splitmix64 finalizer, so sequential ids spread evenly
+  uint64_t x = obj_id + 0x9e3779b97f4a7c15ULL;
+  x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+  x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+  x = x ^ (x >> 31);
+  return (x & (SAMPLE_MODULUS - 1)) < threshold;
+}
+
+double safe_ratio(uint64_t num, uint64_t den) {
+  return den == 0 ? 0.0 : (double)num / den;
 }
 
 bool ends_with(const char *str, const char *suffix) {
@@ -48,6 +186,8 @@ reader_t* get_reader(const char* trace_path) {
     
     if(ends_with(trace_path, ".csv")) return open_trace(trace_path, CSV_TRACE , &init_params);
     else if(ends_with(trace_path, ".zst")) return open_trace(trace_path, ORACLE_GENERAL_TRACE , &init_params);
+    // decompressed copy (see trace_cache.py); libCacheSim mmaps uncompressed binary traces
+    else if(ends_with(trace_path, ".oracleGeneral.bin")) return open_trace(trace_path, ORACLE_GENERAL_TRACE , &init_params);
     else {
         fprintf(stderr, "Unsupported trace format: %s\n", trace_path);
         assert(false);
@@ -0,0 +1,61 @@
+/* priority() plugins: candidates compiled on their own into a shared object instead of into PQEvolve.
+ *
+ * Without POLICYSMITH_PLUGIN_ENTRY, this is the LLMCode.h of the plugin build of PQEvolve: its
+ * priority() forwards to policysmith_priority() from the shared object named by
+ * $POLICYSMITH_PRIORITY_PLUGIN, loaded on the first call.
+ *
+ * With POLICYSMITH_PLUGIN_ENTRY, included after a candidate's priority(), it defines that entry
+ * point. Candidates are compiled against pqevolve_abi.h, the part of the PQEvolve translation unit
+ * that precedes LLMCode.h, so both sides agree on the argument types. */
+#include <dlfcn.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#include "priority_timing.h"
+
+#ifdef POLICYSMITH_PLUGIN_ENTRY
+
+extern "C" int policysmith_priority(
+  uint64_t current_time, obj_id_t obj_id, pq_cache_obj_info& obj_info,
+  CountsInfo<int32_t>& counts, AgeInfo<int64_t> ages, SizeInfo<int64_t>& sizes,
+  History& history
+){
+  return priority(current_time, obj_id, obj_info, counts, ages, sizes, history);
+}
+
+#else
+
+typedef int (*policysmith_priority_t)(
+  uint64_t, obj_id_t, pq_cache_obj_info&, CountsInfo<int32_t>&, AgeInfo<int64_t>, SizeInfo<int64_t>&, History&
+);
+
+static policysmith_priority_t load_priority_plugin() {
+  const char *path = getenv("POLICYSMITH_PRIORITY_PLUGIN");
+  if (path == nullptr) {
+    fprintf(stderr, "POLICYSMITH_PRIORITY_PLUGIN is not set\n");
+    abort();
+  }
+  void *plugin = dlopen(path, RTLD_NOW | RTLD_LOCAL);
+  if (plugin == nullptr) {
+    fprintf(stderr, "dlopen failed: %s\n", dlerror());
+    abort();
+  }
+  policysmith_priority_t fn = (policysmith_priority_t)dlsym(plugin, "policysmith_priority");
+  if (fn == nullptr) {
+    fprintf(stderr, "policysmith_priority not found in %s\n", path);
+    abort();
+  }
+  return fn;
+}
+
+int priority(
+  uint64_t current_time, obj_id_t obj_id, pq_cache_obj_info& obj_info,
+  CountsInfo<int32_t>& counts, AgeInfo<int64_t> ages, SizeInfo<int64_t>& sizes,
+  History& history
+){
+  static policysmith_priority_t fn = load_priority_plugin();
+  policysmith_priority_timer timer;
+  return fn(current_time, obj_id, obj_info, counts, ages, sizes, history);
+}
+
+#endif
@@ -0,0 +1,68 @@
+/* Time spent inside priority(), separate from trace reading and cache bookkeeping.
+ *
+ * The counters are weak so the PQEvolve translation unit (which increments them) and the harness
+ * (which reports them, see simulate.h) share one copy without either having to define it.
+ * In inline builds, WebCacheEvolve writes LLMCode.h as
+ *   #include "priority_timing.h"
+ *   #define priority(...) policysmith_llm_priority(__VA_ARGS__)
+ *   <candidate code>
+ *   #undef priority
+ *   #define POLICYSMITH_TIMED_PRIORITY
+ *   #include "priority_timing.h"
+ * so PQEvolve calls the timed priority() defined at the bottom of this file. */
+#ifndef POLICYSMITH_PRIORITY_TIMING_H
+#define POLICYSMITH_PRIORITY_TIMING_H
+#include <stdint.h>
+#include <algorithm>
+#include <chrono>
+
+__attribute__((weak)) uint64_t policysmith_priority_calls = 0;
+__attribute__((weak)) uint64_t policysmith_priority_timed_calls = 0;
+__attribute__((weak)) uint64_t policysmith_priority_ns = 0; // over the timed calls only
+// 1 in sample_every calls is timed (--time_every); 0, the default, keeps clock reads out of priority()
+__attribute__((weak)) uint64_t policysmith_priority_sample_every = 0;
+
+struct policysmith_priority_timer {
+  bool timed = policysmith_priority_sample_every > 0 && policysmith_priority_calls % policysmith_priority_sample_every == 0;
+  std::chrono::steady_clock::time_point start;
+  policysmith_priority_timer() {
+    if (timed) start = std::chrono::steady_clock::now();
+  }
+  ~policysmith_priority_timer() {
+    policysmith_priority_calls++;
+    if (timed) {
+      policysmith_priority_timed_calls++;
+      policysmith_priority_ns += std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - start).count();
+    }
+  }
+};
+
+/* What one start/stop pair of steady_clock::now() adds to a measured interval, subtracted from
+ * every timed interval. Measured once, as the cheapest of a few batches of back-to-back reads. */
+inline double policysmith_timer_overhead_ns() {
+  static double overhead = [] {
+    const int n = 1000;
+    double best = 1e9;
+    for (int batch = 0; batch < 10; batch++) {
+      auto start = std::chrono::steady_clock::now();
+      for (int i = 0; i < n; i++) (void)std::chrono::steady_clock::now();
+      double per_read = std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count() / (n + 1);
+      best = std::min(best, per_read);
+    }
+    return best;
+  }();
+  return overhead;
+}
+#endif
+
+#if defined(POLICYSMITH_TIMED_PRIORITY) && !defined(POLICYSMITH_TIMED_PRIORITY_DEFINED)
+#define POLICYSMITH_TIMED_PRIORITY_DEFINED
+int priority(
+  uint64_t current_time, obj_id_t obj_id, pq_cache_obj_info& obj_info,
+  CountsInfo<int32_t>& counts, AgeInfo<int64_t> ages, SizeInfo<int64_t>& sizes,
+  History& history
+){
+  policysmith_priority_timer timer;
+  return policysmith_llm_priority(current_time, obj_id, obj_info, counts, ages, sizes, history);
+}
+#endif
@@ -79,7 +79,7 @@ int main(int argc, char *argv[]) {
   assert(argc == 4);
   const char *trace_path = argv[1];
   reader_t *reader = get_reader(trace_path);
-  TRACE_FOOTPRINT_BYTES = calculate_trace_footprint(reader);
+  TRACE_FOOTPRINT_BYTES = get_trace_metadata(reader).footprint_bytes;
 
   // set cache parameters
   if(std::string(argv[2]) == "percent") {
@@ -0,0 +1,200 @@
+/* The simulation shared by run_multiple_sizes (one candidate per process) and eval_server
+ * (candidates loaded as shared objects into a long-lived process). */
+#pragma once
+#include "main.h"
+#include "priority_timing.h"
+
+std::vector<uint64_t> cache_sizes;
+long max_req = -1;          // --max_req=N: only simulate the first N requests (racing prefix)
+long checkpoint_every = 0;  // --checkpoint_every=N: print partial miss ratios every N requests
+double sample_rate = 1.0;   // --sample_rate=R: only simulate objects sampled at rate R, with caches scaled by R
+std::string baseline;       // --baseline=LRU: simulate LRU instead of PQEvolve (exact reference for --sample_rate)
+long time_every = 0;        // --time_every=N: time 1 in N requests and priority() calls; 0 leaves the loop free of clock reads
+
+// where priority() time is accumulated; eval_server points these at the counters of a dlopen'd candidate
+uint64_t *priority_calls_counter = &policysmith_priority_calls;
+uint64_t *priority_timed_counter = &policysmith_priority_timed_calls;
+uint64_t *priority_ns_counter = &policysmith_priority_ns;
+uint64_t *priority_sample_every = &policysmith_priority_sample_every;
+// estimated from the timed requests, scaled to all of them (only with --time_every)
+double trace_read_seconds = 0;  // in read_trace
+double simulate_seconds = 0;    // in cache->get (priority() plus cache bookkeeping)
+
+void print_checkpoint(cache_stat_t *result) {
+  for (size_t i = 0; i < cache_sizes.size(); i++) {
+    printf(
+      "{\"checkpoint\": %lu, \"cache_size_mb\": %llu, \"cache_size_bytes\": %lu, \"miss_ratio\": %.4f, \"byte_miss_ratio\": %.4f}\n",
+        result[i].n_req, result[i].cache_size / MiB, result[i].cache_size,
+        safe_ratio(result[i].n_miss, result[i].n_req),
+        safe_ratio(result[i].n_miss_byte, result[i].n_req_byte)
+    );
+  }
+  fflush(stdout);
+}
+
+void feed(cache_t *cache, cache_stat_t *result, request_t *req) {
+  result->n_req++;
+  result->n_req_byte += req->obj_size;
+  if (!cache->get(cache, req)) {
+    result->n_miss++;
+    result->n_miss_byte += req->obj_size;
+  }
+}
+
+/* Feeds every request of a single pass over the trace to one cache per size, so any number of
+ * sizes (a whole miss-ratio curve) costs one trace read, and the simulation can report
+ * intermediate miss ratios and stop after max_req requests.
+ * When sampling, the same sampled requests also go to LRU caches of the same (scaled) sizes,
+ * whose miss ratios (lru_result) are compared with exact LRU to estimate the sampling error. */
+cache_stat_t *simulate_sizes(reader_t *reader, cache_t *cache, cache_stat_t **lru_result) {
+  bool sampled = sample_rate < 1.0;
+  uint64_t threshold = sample_threshold(sample_rate);
+  common_cache_params_t lru_params = default_common_cache_params();
+  size_t n_sizes = cache_sizes.size();
+  std::vector<cache_t *> caches(n_sizes), lru_caches(n_sizes);
+  cache_stat_t *result = (cache_stat_t *)calloc(n_sizes, sizeof(cache_stat_t));
+  *lru_result = sampled ? (cache_stat_t *)calloc(n_sizes, sizeof(cache_stat_t)) : nullptr;
+  for (size_t i = 0; i < n_sizes; i++) {
+    uint64_t simulated_size = std::max((uint64_t)1, (uint64_t)(cache_sizes[i] * sample_rate));
+    caches[i] = create_cache_with_new_size(cache, simulated_size);
+    strncpy(result[i].cache_name, caches[i]->cache_name, sizeof(result[i].cache_name) - 1);
+    result[i].cache_size = cache_sizes[i];
+    if (sampled) {
+      lru_params.cache_size = simulated_size;
+      lru_caches[i] = LRU_init(lru_params, nullptr);
+    }
+  }
+
+  reset_reader(reader);
+  request_t *req = new_request();
+  long n_req = 0, n_timed = 0;
+  *priority_calls_counter = 0;
+  *priority_timed_counter = 0;
+  *priority_ns_counter = 0;
+  *priority_sample_every = time_every;
+  std::chrono::duration<double, std::nano> read_time(0), simulate_time(0);
+  std::chrono::steady_clock::time_point t0, t1;
+  while (max_req < 0 || n_req < max_req) {
+    bool timed = time_every > 0 && n_req % time_every == 0;
+    if (timed) t0 = std::chrono::steady_clock::now();
+    if (read_trace(reader, req) != 0) break;
+    if (timed) t1 = std::chrono::steady_clock::now();
+    n_req++;
+    if (!sampled || sample_object(req->obj_id, threshold)) {
+      for (size_t i = 0; i < n_sizes; i++) {
+        feed(caches[i], &result[i], req);
+        if (sampled) feed(lru_caches[i], &(*lru_result)[i], req);
+      }
+    }
+    if (timed) {
+      read_time += t1 - t0;
+      simulate_time += std::chrono::steady_clock::now() - t1;
+      n_timed++;
+    }
+    if (checkpoint_every > 0 && n_req % checkpoint_every == 0) print_checkpoint(result);
+  }
+  if (n_timed > 0) {
+    double overhead = policysmith_timer_overhead_ns();
+    trace_read_seconds = std::max(0.0, read_time.count() / n_timed - overhead) * n_req / 1e9;
+    simulate_seconds = std::max(0.0, simulate_time.count() / n_timed - overhead) * n_req / 1e9;
+  }
+
+  free_request(req);
+  for (size_t i = 0; i < n_sizes; i++) {
+    caches[i]->cache_free(caches[i]);
+    if (sampled) lru_caches[i]->cache_free(lru_caches[i]);
+  }
+  return result;
+}
+
+typedef cache_t *(*cache_init_func_t)(const common_cache_params_t, const char *);
+
+void run_one_cache_multiple_sizes(reader_t *reader, cache_init_func_t cache_init) {
+  auto start = std::chrono::high_resolution_clock::now();
+
+  common_cache_params_t cc_params = default_common_cache_params();
+  cc_params.cache_size = 1 * GiB;  // any size should work
+
+  cache_t *cache;
+
+  if (baseline == "LRU") cache = LRU_init(cc_params, nullptr);
+  else {
+    assert(baseline.empty());
+    cache = cache_init(cc_params, nullptr);
+  }
+
+  cache_stat_t *lru_result;
+  cache_stat_t *result = simulate_sizes(reader, cache, &lru_result);
+  
+  auto end = std::chrono::high_resolution_clock::now();
+  double duration_sec = std::chrono::duration<double>(end - start).count();
+
+  // priority() cost is per request seen by the candidate's caches (all sizes together); the timed
+  // calls, minus the cost of the clock reads, stand for all of them
+  uint64_t n_cache_req = 0;
+  for (size_t i = 0; i < cache_sizes.size(); i++) n_cache_req += result[i].n_req;
+  bool timed = time_every > 0 && *priority_timed_counter > 0;
+  double ns_per_call = timed ? std::max(0.0, (double)*priority_ns_counter / *priority_timed_counter - policysmith_timer_overhead_ns()) : 0;
+  double priority_ns = ns_per_call * *priority_calls_counter;
+  
+  for (size_t i = 0; i < cache_sizes.size(); i++) {
+    printf(
+      "{\"cache_name\": \"%s\", \"cache_size_mb\": %llu, \"cache_size_bytes\": %lu, \"n_miss\": %lu, \"n_req\": %lu, "
+      "\"miss_ratio\": %.4f, \"byte_miss_ratio\": %.4f, \"runtime_seconds\":%.6f",
+        result[i].cache_name, result[i].cache_size / MiB, result[i].cache_size, result[i].n_miss, result[i].n_req,
+        safe_ratio(result[i].n_miss, result[i].n_req),
+        safe_ratio(result[i].n_miss_byte, result[i].n_req_byte),
+        duration_sec
+    );
+    printf(", \"priority_calls\": %lu", *priority_calls_counter);
+    if (time_every > 0) {
+      printf(
+        ", \"time_every\": %ld, \"trace_read_seconds\": %.6f, \"simulate_seconds\": %.6f, \"priority_seconds\": %.6f",
+          time_every, trace_read_seconds, simulate_seconds, priority_ns / 1e9
+      );
+      if (timed) printf(", \"priority_ns_per_call\": %.1f, \"priority_ns_per_request\": %.1f", ns_per_call, n_cache_req > 0 ? priority_ns / n_cache_req : 0.0);
+    }
+    if (lru_result != nullptr) {
+      printf(
+        ", \"sample_rate\": %.6f, \"lru_sampled_miss_ratio\": %.4f, \"lru_sampled_byte_miss_ratio\": %.4f",
+          sample_rate,
+          safe_ratio(lru_result[i].n_miss, lru_result[i].n_req),
+          safe_ratio(lru_result[i].n_miss_byte, lru_result[i].n_req_byte)
+      );
+    }
+    printf("}\n");
+  }
+  cache->cache_free(cache);
+  free(result);
+  free(lru_result);
+}
+
+/* Reads the simulation options, then turns the <size_type: percent/mb> <size1> ... <sizeN> arguments
+ * (or <min> <max> with --sweep=N) into cache_sizes. Needs TRACE_FOOTPRINT_BYTES to be set. */
+void set_simulation_options(std::map<std::string, std::string> &options) {
+  max_req = options.count("max_req") ? std::stol(options["max_req"]) : -1;
+  checkpoint_every = options.count("checkpoint_every") ? std::stol(options["checkpoint_every"]) : 0;
+  sample_rate = options.count("sample_rate") ? std::stod(options["sample_rate"]) : 1.0;
+  baseline = options.count("baseline") ? options["baseline"] : "";
+  time_every = options.count("time_every") ? std::stol(options["time_every"]) : 0;
+  assert(time_every >= 0);
+  assert(sample_rate > 0 && sample_rate <= 1.0);
+}
+
+void set_cache_sizes(const std::string &size_type, std::vector<double> sizes, std::map<std::string, std::string> &options) {
+  if (options.count("sweep")) {
+    int n = std::stoi(options["sweep"]);
+    assert(sizes.size() == 2 && n >= 2 && 0 < sizes[0] && sizes[0] < sizes[1]);
+    double lo = sizes[0], hi = sizes[1];
+    sizes.clear();
+    for (int i = 0; i < n; i++) sizes.push_back(lo * pow(hi / lo, (double)i / (n - 1)));
+  }
+
+  cache_sizes.clear();
+  for (double size : sizes) {
+    if(size_type == "percent") cache_sizes.push_back(size * TRACE_FOOTPRINT_BYTES);
+    else if(size_type == "mb") cache_sizes.push_back(size * MiB);
+    else assert(false);
+    assert(cache_sizes.back() < (uint64_t)TRACE_FOOTPRINT_BYTES);
+  }
+}
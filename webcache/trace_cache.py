@@ -0,0 +1,131 @@
+"""
+Local cache of decompressed traces. libCacheSim streams .oracleGeneral.bin.zst traces through a
+private zstd decompression buffer on every run, while an uncompressed .oracleGeneral.bin (fixed
+24-byte records) is mmap'd, so concurrent simulations of the same trace share page-cache pages.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+
+from webcache.trace_metadata import load_trace_metadata, trace_metadata_path, write_trace_metadata
+
+ORACLE_GENERAL_RECORD_BYTES = 24
+
+class TraceCache:
+    """
+    Each entry <key>.oracleGeneral.bin has a <key>.lock file next to it: evaluators hold a shared
+    flock on it while simulating, the process decompressing the entry holds it exclusively, and its
+    mtime is the LRU clock. Entries not in use are evicted, least recently used first, once the
+    cache grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def entry_path(self, trace_path: str) -> str:
+        # keyed by the source's path, size and mtime, so a replaced trace gets a fresh entry
+        st = os.stat(trace_path)
+        key = hashlib.sha256(f"{os.path.abspath(trace_path)}:{st.st_size}:{int(st.st_mtime)}".encode()).hexdigest()[:16]
+        name = os.path.basename(trace_path)
+        if name.endswith(".zst"):
+            name = name[:-len(".zst")]
+        return os.path.join(self.cache_dir, f"{key}_{name}")
+
+    @staticmethod
+    def cacheable(trace_path: str) -> bool:
+        return trace_path.endswith(".oracleGeneral.bin.zst")
+
+    def decompress(self, trace_path: str, path: str):
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        proc = subprocess.run(
+            f"zstd -d -q -f -o {shlex.quote(tmp_path)} {shlex.quote(trace_path)}",
+            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        if proc.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(f"Could not decompress {trace_path}: {proc.stderr.strip()}")
+        assert os.path.getsize(tmp_path) % ORACLE_GENERAL_RECORD_BYTES == 0, f"{trace_path} is not an oracleGeneral trace"
+        os.replace(tmp_path, path)
+
+        # the harness would otherwise recompute the footprint on its first run over the new file
+        meta = load_trace_metadata(trace_path)
+        if meta is not None:
+            write_trace_metadata(path, meta)
+
+    @contextlib.contextmanager
+    def use(self, trace_path: str):
+        """
+        Yields the path of the decompressed copy of trace_path, decompressing it first if needed.
+        The entry cannot be evicted until the with-block exits.
+        """
+        if not self.cacheable(trace_path):
+            yield trace_path
+            return
+
+        path = self.entry_path(trace_path)
+        lock_path = path + ".lock"
+        with open(lock_path, "a") as lock:
+            decompressed = False
+            while True:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if os.path.exists(path):
+                    break
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    self.decompress(trace_path, path)
+                    decompressed = True
+            os.utime(lock_path)
+            with self.lock:
+                if decompressed:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if decompressed and self.max_bytes is not None:
+                self.evict()
+            yield path
+
+    def entries(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".oracleGeneral.bin"):
+                yield os.path.join(self.cache_dir, name)
+
+    def evict(self):
+        """
+        Drops unused entries, least recently used first, until the cache fits in max_bytes.
+        Entries whose lock is held (being simulated or decompressed) are skipped.
+        """
+        with open(os.path.join(self.cache_dir, ".evict.lock"), "a") as evict_lock:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            last_used = lambda path: os.path.getmtime(path + ".lock") if os.path.exists(path + ".lock") else 0
+            paths = sorted(self.entries(), key=last_used)
+            total_bytes = sum(os.path.getsize(path) for path in paths)
+            for path in paths:
+                if total_bytes <= self.max_bytes:
+                    break
+                with open(path + ".lock", "a") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    if os.path.exists(trace_metadata_path(path)):
+                        os.remove(trace_metadata_path(path))
+                    total_bytes -= size
+                    with self.lock:
+                        self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,49 @@
+"""
+Reads the <trace>.meta.json sidecars written by the C++ harnesses (see get_trace_metadata in main.h).
+"""
+import json
+import os
+import subprocess
+
+TRACE_METADATA_VERSION = 1
+
+def trace_metadata_path(trace_path):
+    return trace_path + ".meta.json"
+
+def load_trace_metadata(trace_path):
+    """
+    Returns the sidecar contents, or None if it is missing or stale (trace size/mtime changed).
+    """
+    try:
+        with open(trace_metadata_path(trace_path)) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    st = os.stat(trace_path)
+    if meta.get("version") != TRACE_METADATA_VERSION or meta.get("trace_size_bytes") != st.st_size or meta.get("trace_mtime") != int(st.st_mtime):
+        return None
+    return meta
+
+def ensure_trace_metadata(trace_path, footprint_binary):
+    """
+    Loads the sidecar, running get_footprint.o once to create it if needed.
+    """
+    meta = load_trace_metadata(trace_path)
+    if meta is None:
+        subprocess.run([footprint_binary, trace_path], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        meta = load_trace_metadata(trace_path)
+        assert meta is not None, f"{footprint_binary} did not write a metadata sidecar for {trace_path}"
+    return meta
+
+def write_trace_metadata(trace_path, meta):
+    """
+    Writes meta as the sidecar of trace_path, stamped with trace_path's own size/mtime. Used to
+    carry metadata over to a derived copy of a trace (e.g. a decompressed one in the trace cache).
+    """
+    st = os.stat(trace_path)
+    meta = dict(meta, version=TRACE_METADATA_VERSION, trace_size_bytes=st.st_size, trace_mtime=int(st.st_mtime))
+    tmp_path = f"{trace_metadata_path(trace_path)}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, separators=(",", ":")) # main.h looks fields up as "key":value
+    os.replace(tmp_path, trace_metadata_path(trace_path))